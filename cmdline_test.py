@@ -14,20 +14,231 @@
 # Used to test hostlistd:
 # $ ./cmdline_test.py OPEN MOD Evo
 #
+# With -c it becomes a load generator: N connections send a mix of queries
+# at a target rate, every reply is checked and latencies are reported:
+# $ ./cmdline_test.py -c 50 -r 500 -d 30 --pid $(pgrep -f main.py)
+# $ ./cmdline_test.py -c 10 --reconnect "OPEN NONE" "ALL MOD evo|zero k"
+# $ ./cmdline_test.py -c 10 "ZOPEN NONE" "ZALL MOD evo" "FORMAT BIN ALL NONE" "FORMAT JSON OPEN NONE" STATS
+#
 
+import argparse
+import json
+import random
+import socket
 import sys
 import telnetlib
+import threading
+import time
+import zlib
 
 from hostlistd.settings import HOST, PORT
+from hostlistd import binformat
+
+# default query mix for load tests: ALL/OPEN/INGAME x NONE/MOD/HOST
+DEFAULT_MIX = ["%s %s" % (command, filter_) for command in ("ALL", "OPEN", "INGAME")
+               for filter_ in ("NONE", "MOD Evo", "MOD Evolution|Zero-K", "HOST [teh]")]
+
+
+class FramingError(Exception):
+    pass
+
+
+def single_query(data):
+    tn = telnetlib.Telnet(HOST, PORT)
+
+    tn.write(data + "\n")
+    print "Sent:     '{}'".format(data)
+
+    recv = tn.expect(["^END.*"], 2)
+    print "Received: '{}'".format(recv[2])
+
+    tn.close()
+
+
+def read_reply(rfile, stats=False):
+    """
+    Reads a START ... END n reply, returns its size in bytes. Raises
+    FramingError if n doesn't match the number of rows. stats: reply to a
+    STATS request, n is its number of lines.
+    """
+    line = rfile.readline()
+    if not line.startswith("START "):
+        raise FramingError("expected START, got %r" % line[:40])
+    size = len(line)
+    rows = 0
+    while True:
+        line = rfile.readline()
+        if not line:
+            raise FramingError("connection closed before END")
+        size += len(line)
+        if line.startswith("END "):
+            break
+        if rows == 0 and not stats and line.strip().isdigit():
+            # Z, FORMAT BIN or FORMAT JSON reply: length of the payload
+            payload = rfile.read(int(line))
+            size += len(payload)
+            try:
+                if not payload.startswith(binformat.MAGIC) and not payload.startswith("{"):
+                    payload = zlib.decompress(payload)
+                # + 1 for the CSV header
+                if payload.startswith(binformat.MAGIC):
+                    rows = len(binformat.decode(payload)[1]) + 1
+                elif payload.startswith("{"):
+                    rows = len(json.loads(payload)["hosts"]) + 1
+                else:
+                    rows = payload.count("\r\n")
+            except (zlib.error, binformat.BinFormatError, ValueError, KeyError), e:
+                raise FramingError("bad payload: %s" % e)
+            continue
+        rows += 1
+    count = int(line.split()[1])
+    if stats:
+        if count != rows:
+            raise FramingError("END %d, but %d lines received" % (count, rows))
+        return size
+    # the header is sent only if there are hosts
+    if count != max(rows - 1, 0):
+        raise FramingError("END %d, but %d rows received" % (count, rows))
+    return size
+
+
+def server_rss(pid):
+    """
+    Returns VmRSS of process pid in KiB or None.
+    """
+    try:
+        for line in open("/proc/%d/status" % pid):
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1])
+    except (IOError, TypeError):
+        return None
+
+
+class LoadClient(threading.Thread):
+    def __init__(self, num, queries, interval, end_time, reconnect, stats):
+        super(LoadClient, self).__init__(name="load-%d" % num)
+        self.daemon = True
+        self.random = random.Random(num)
+        self.queries = queries
+        self.interval = interval  # seconds between two queries, 0: as fast as possible
+        self.end_time = end_time
+        self.reconnect = reconnect  # new connection for each query
+        self.stats = stats
+
+    def run(self):
+        sock = rfile = None
+        next_query = time.time() + self.random.random() * self.interval  # spread the start
+        while time.time() < self.end_time:
+            if self.interval:
+                wait = next_query - time.time()
+                if wait > 0:
+                    time.sleep(wait)
+                next_query += self.interval
+            query = self.random.choice(self.queries)
+            start = time.time()
+            try:
+                if sock is None:
+                    sock = socket.create_connection((HOST, PORT), 10)
+                    rfile = sock.makefile("rb")
+                sock.sendall(query + "\n")
+                size = read_reply(rfile, query == "STATS")
+                self.stats.success(time.time() - start, size)
+            except FramingError, fe:
+                self.stats.error("framing", fe)
+                sock = self.close(sock)
+            except socket.timeout, to:
+                self.stats.error("timeout", to)
+                sock = self.close(sock)
+            except (socket.error, ValueError), e:
+                self.stats.error("socket", e)
+                sock = self.close(sock)
+                # don't flood a server that refuses connections
+                time.sleep(0.1)
+            if self.reconnect:
+                sock = self.close(sock)
+        self.close(sock)
+
+    @staticmethod
+    def close(sock):
+        if sock:
+            sock.close()
+        return None
+
+
+class LoadStats(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = list()
+        self.bytes = 0
+        self.errors = dict()  # type -> count
+        self.last_errors = list()
+
+    def success(self, latency, size):
+        with self.lock:
+            self.latencies.append(latency)
+            self.bytes += size
+
+    def error(self, kind, exc):
+        with self.lock:
+            self.errors[kind] = self.errors.get(kind, 0) + 1
+            self.last_errors = (self.last_errors + ["%s: %s" % (kind, exc)])[-5:]
+
+    def report(self, elapsed, rss):
+        latencies = sorted(self.latencies)
+
+        def percentile(p):
+            return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else 0.0
+
+        print "Replies:    %d in %0.1f sec, %0.1f/sec, %0.1f KiB/sec" % (
+            len(latencies), elapsed, len(latencies) / elapsed, self.bytes / 1024.0 / elapsed)
+        print "Latency ms: p50 %0.2f  p95 %0.2f  p99 %0.2f  max %0.2f" % (
+            percentile(0.5), percentile(0.95), percentile(0.99), latencies[-1] * 1000 if latencies else 0.0)
+        print "Errors:     %d %s" % (sum(self.errors.values()), self.errors or "")
+        for error in self.last_errors:
+            print "            %s" % error
+        if rss:
+            print "Server RSS: start %d KiB, end %d KiB, max %d KiB" % (rss[0], rss[-1], max(rss))
+
+
+def load_test(args):
+    queries = [" ".join(q.split()) for q in args.query] or DEFAULT_MIX
+    interval = float(args.connections) / args.rate if args.rate else 0
+    stats = LoadStats()
+    start = time.time()
+    end_time = start + args.duration
+    clients = [LoadClient(num, queries, interval, end_time, args.reconnect, stats)
+               for num in range(args.connections)]
+    print "%d connections%s, %s queries/sec, %d sec, %d different queries" % (
+        args.connections, " (reconnecting)" if args.reconnect else "", args.rate or "max", args.duration,
+        len(queries))
+    for client in clients:
+        client.start()
+    rss = list()
+    while any(client.is_alive() for client in clients):
+        sample = server_rss(args.pid)
+        if sample:
+            rss.append(sample)
+        time.sleep(0.5)
+    stats.report(time.time() - start, rss)
 
-data = " ".join(sys.argv[1:])
 
-tn = telnetlib.Telnet(HOST, PORT)
+def main():
+    parser = argparse.ArgumentParser(description="Query hostlistd once, or run a load test with -c.")
+    parser.add_argument("query", nargs="*",
+                        help="query words (single query) or quoted queries to mix (load test)")
+    parser.add_argument("-c", "--connections", type=int, default=0, help="number of concurrent connections")
+    parser.add_argument("-r", "--rate", type=float, default=0,
+                        help="target queries/sec over all connections (default: as fast as possible)")
+    parser.add_argument("-d", "--duration", type=float, default=10, help="seconds to run (default: %(default)s)")
+    parser.add_argument("--reconnect", action="store_true", help="new connection for each query")
+    parser.add_argument("--pid", type=int, help="PID of the server to report its RSS")
+    args = parser.parse_args()
 
-tn.write(data + "\n")
-print "Sent:     '{}'".format(data)
+    if args.connections:
+        load_test(args)
+    else:
+        single_query(" ".join(args.query))
 
-recv = tn.expect(["^END.*"], 2)
-print "Received: '{}'".format(recv[2])
 
-tn.close()
+if __name__ == "__main__":
+    sys.exit(main())
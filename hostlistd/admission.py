@@ -0,0 +1,93 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import socket
+import threading
+import time
+
+
+class Admission(object):
+    """
+    Per client IP limits: open connections and a token bucket of requests,
+    refilled with rate tokens per second up to burst. None disables a limit.
+    """
+    def __init__(self, max_connections, rate, burst):
+        self.max_connections = max_connections
+        self.rate = rate
+        self.burst = burst
+        self.connections = dict()  # IP -> open connections
+        self.buckets = dict()  # IP -> (tokens, time.time() of the last request)
+        self.last_sweep = time.time()
+        self.lock = threading.Lock()
+
+    def connect(self, ip):
+        """
+        Returns True if a new connection from ip is admitted, it must be
+        followed by disconnect(ip) then.
+        """
+        with self.lock:
+            count = self.connections.get(ip, 0)
+            if self.max_connections is not None and count >= self.max_connections:
+                return False
+            self.connections[ip] = count + 1
+            return True
+
+    def disconnect(self, ip):
+        with self.lock:
+            count = self.connections.pop(ip) - 1
+            if count:
+                self.connections[ip] = count
+
+    def request(self, ip):
+        """
+        Returns True if ip may send another request now, and takes a token.
+        """
+        if self.rate is None:
+            return True
+        now = time.time()
+        with self.lock:
+            tokens, last = self.buckets.get(ip, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens < 1:
+                self.buckets[ip] = (tokens, now)
+                return False
+            self.buckets[ip] = (tokens - 1, now)
+            if now - self.last_sweep > float(self.burst) / self.rate:
+                self._sweep(now)
+            return True
+
+    def _sweep(self, now):
+        # buckets that were refilled completely are the same as no bucket
+        full = now - float(self.burst) / self.rate
+        for ip, (_, last) in self.buckets.items():
+            if last < full:
+                del self.buckets[ip]
+        self.last_sweep = now
+
+
+def sendall(sock, data, timeout):
+    """
+    socket.sendall() that raises socket.timeout if the client didn't read
+    all of data within timeout seconds (None: no limit). The timeout of
+    sock is restored.
+    """
+    if timeout is None:
+        sock.sendall(data)
+        return
+    old_timeout = sock.gettimeout()
+    deadline = time.time() + timeout
+    view = buffer(data)
+    try:
+        while view:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise socket.timeout("Client didn't read the reply within %s seconds." % timeout)
+            sock.settimeout(remaining)
+            view = buffer(view, sock.send(view))
+    finally:
+        sock.settimeout(old_timeout)
@@ -0,0 +1,87 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Binary encoding of host lists, for requests with FORMAT BIN.
+#
+# All numbers are little endian.
+#
+#   payload := header string* row*
+#   header  := "HLB1" generation:uint64 host_count:uint32 string_count:uint32
+#   string  := length:uint16 UTF-8 bytes
+#   row     := battleID:int32 founder:uint32 passworded:uint8 rank:uint8
+#              engineVersion:uint32 map:uint32 title:uint32 gameName:uint32
+#              locked:uint8 spec_count:uint16 player_count:int16
+#              is_ingame:uint8
+#
+# The uint32 fields of a row are indexes into the string table, which holds
+# each distinct string once. The columns are those of the CSV (CSV_HEADER).
+#
+
+import struct
+
+MAGIC = "HLB1"
+HEADER = struct.Struct("<4sQII")
+STRING_LENGTH = struct.Struct("<H")
+ROW = struct.Struct("<iIBBIIIIBHhB")
+MAX_STRING_LENGTH = 0xffff
+
+
+class BinFormatError(Exception):
+    pass
+
+
+def encode(host_list, generation):
+    """
+    Returns the payload for the HostRecords in host_list.
+    """
+    strings = dict()  # unicode -> index
+    ref = strings.setdefault
+    pack = ROW.pack
+    rows = list()
+    for host in host_list:
+        # tuple unpacking is much faster than namedtuple attribute access
+        (battleID, founder, passworded, rank, engineVersion, _map, title, gameName, locked, spec_count, player_count,
+         is_ingame) = host[:12]
+        rows.append(pack(int(battleID), ref(founder, len(strings)), int(passworded), int(rank),
+                         ref(engineVersion, len(strings)), ref(_map, len(strings)), ref(title, len(strings)),
+                         ref(gameName, len(strings)), locked, spec_count, player_count, is_ingame))
+    table = [None] * len(strings)
+    for text, index in strings.iteritems():
+        data = text.encode("utf-8")[:MAX_STRING_LENGTH]
+        table[index] = STRING_LENGTH.pack(len(data)) + data
+    return HEADER.pack(MAGIC, generation, len(rows), len(table)) + "".join(table) + "".join(rows)
+
+
+def decode(payload):
+    """
+    Returns (generation, list of rows), each row a list of the CSV_HEADER
+    columns, with ints, bools and unicode strings.
+    """
+    try:
+        magic, generation, host_count, string_count = HEADER.unpack_from(payload)
+        if magic != MAGIC:
+            raise BinFormatError("Bad magic %r." % magic)
+        offset = HEADER.size
+        strings = list()
+        for _ in xrange(string_count):
+            length, = STRING_LENGTH.unpack_from(payload, offset)
+            offset += STRING_LENGTH.size
+            strings.append(payload[offset:offset + length].decode("utf-8"))
+            offset += length
+        rows = list()
+        for _ in xrange(host_count):
+            (battleID, founder, passworded, rank, engineVersion, _map, title, gameName, locked, spec_count,
+             player_count, is_ingame) = ROW.unpack_from(payload, offset)
+            offset += ROW.size
+            rows.append([battleID, strings[founder], passworded, rank, strings[engineVersion], strings[_map],
+                         strings[title], strings[gameName], bool(locked), spec_count, player_count,
+                         bool(is_ingame)])
+    except (struct.error, IndexError, UnicodeDecodeError), e:
+        raise BinFormatError("Truncated or corrupt payload: %s" % e)
+    return generation, rows
@@ -0,0 +1,65 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+from collections import OrderedDict
+
+
+class ResponseCache(object):
+    """
+    LRU cache of fully encoded response bodies.
+
+    All entries belong to one generation of the lobby state. When a lookup
+    is done with a newer generation, the whole cache is dropped. Lookups
+    with an older generation (requests still using the previous snapshot)
+    are misses and leave the cache alone.
+    """
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.generation = None
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, generation):
+        with self.lock:
+            if self.generation is None or generation > self.generation:
+                self.entries.clear()
+                self.generation = generation
+            elif generation < self.generation:
+                self.misses += 1
+                return None
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            # re-insert to mark as most recently used
+            self.entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, generation, value):
+        with self.lock:
+            if generation != self.generation:
+                # lobby state changed while rendering, don't store outdated data
+                return
+            self.entries[key] = value
+            if len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def __len__(self):
+        return len(self.entries)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return "%d entries, %d hits, %d misses (%0.1f%% hits), %d evictions" % (
+            len(self.entries), self.hits, self.misses, 100.0 * self.hits / total if total else 0.0, self.evictions)
@@ -7,49 +7,75 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import threading
+import multiprocessing
+import os
 import socket
+import select
+import errno
 import SocketServer
+import BaseHTTPServer
+import json
 import logging
-import csv
-import cStringIO
 import datetime
+import heapq
+import subprocess
+import sys
+import time
+import zlib
 
-from settings import HOST, PORT, MAX_CONNECTION_LENGTH
-from unicodewriter import UnicodeWriter
+from settings import HOST, PORT, MAX_CONNECTION_LENGTH, MAX_REQUEST_LENGTH, RESPONSE_CACHE_SIZE, SERVER_MODE, \
+    WATCH_INTERVAL, METRICS_HOST, METRICS_PORT, WORKERS, SNAPSHOT_FILE, SNAPSHOT_INTERVAL, COMPRESSION_LEVEL, \
+    HTTP_HOST, HTTP_PORT, MAX_CONNECTIONS_PER_IP, MAX_REQUEST_RATE, MAX_REQUEST_BURST, WRITE_TIMEOUT, \
+    MAX_OUTPUT_BUFFER, QUERY_STATS_SIZE, QUERY_STATS_HALF_LIFE, CACHE_WARM_QUERIES, CACHE_WARM_MIN_RATE
+from lobbyclient.index import sort_key, where_matches
+from lobbyclient.models import CSV_HEADER, CSV_HEADER_ROW, encode_csv_row
+from metrics import REGISTRY, Counter, Gauge, Histogram, start_http_server
+from cache import ResponseCache
+from query import Query, QueryError
+from watch import Subscription
+from admission import Admission, sendall
+from querystats import QueryStats
+import binformat
+from shared import SnapshotWriter
+from httpapi import HTTPRequestHandler
+
+# not in the socket module of Python 2.7, Linux value
+SO_REUSEPORT = getattr(socket, "SO_REUSEPORT", 15)
+
+# started by WorkerPool
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "hostlistd_worker.py")
 
 logger = logging.getLogger()
 
+# COMMAND -> host list of Snapshot and Lobbyclient
+COMMAND_LISTS = {"ALL": "hosts", "OPEN": "hosts_open", "INGAME": "hosts_ingame"}
 
-def substr_search(words, text):
-    """
-    Case-insensitive search for words in text.
-    Returns True if all words exist in text.
-    """
-    text = text.upper()
-    words = words.split()
-    if len(words) > 1:
-        words_exist_in_text = map(lambda x: x.upper() in text, words)
-        return reduce(lambda x, y: x and y, words_exist_in_text, True)
-    elif len(words) == 1:
-        return words[0].upper() in text
-    else:
-        return False
+# FILTER-TYPE -> search index of the lobbyclient
+FILTER_FIELDS = {"MOD": "gameName", "HOST": "founder", "DESC": "description"}
+
+# most frequent queries in the metrics
+TOP_QUERIES = 20
+
+# column name -> index in HostRecord
+FIELD_INDEXES = dict((field, index) for index, field in enumerate(CSV_HEADER))
+
+REQUEST_SECONDS = Histogram("hostlistd_request_seconds", "Time to answer a request.", ("command", "filter"))
+REQUEST_ERRORS = Counter("hostlistd_request_errors_total", "Invalid requests.")
+SENT_BYTES = Counter("hostlistd_sent_bytes_total", "Bytes of replies and WATCH updates.")
+CONNECTIONS = Counter("hostlistd_connections_total", "Accepted connections.")
+CONNECTIONS_ACTIVE = Gauge("hostlistd_connections_active", "Open connections.")
+REJECTED = Counter("hostlistd_rejected_total", "Connections closed by the per IP limits (reason connections, rate) "
+                   "or because the client didn't read its replies (slow).", ("reason",))
 
 
 class ThreadedTCPRequestHandler(SocketServer.StreamRequestHandler, object):
     """
     Request handler, each connection gets an new object of this class.
     """
-    hosts = None  # dict of lobbyclient.model.Host
-    hosts_open = None  # dict of lobbyclient.model.Host
-    hosts_ingame = None  # dict of lobbyclient.model.Host
     name = ""  # name of thread
 
     def setup(self):
         logger.debug("Connetion from %s:%d", self.client_address[0], self.client_address[1])
-        self.hosts = self.server.hosts
-        self.hosts_open = self.server.hosts_open
-        self.hosts_ingame = self.server.hosts_ingame
         self.server.connection_count += 1
         self.name = "hostlistd-request-%s:%d" % self.client_address
         self.thread = threading.current_thread()
@@ -62,20 +88,68 @@ class ThreadedTCPRequestHandler(SocketServer.StreamRequestHandler, object):
         Reply to incoming requests.
 
         Request:
-            <COMMAND> <FILTER-TYPE> [SUBSTRING ...]
+            [WATCH] [FORMAT <FORMAT>] [FIELDS <FIELD>,...]
+            [WHERE <PREDICATE> [AND|OR <PREDICATE> ...]]
+            [ORDER BY <SORT-FIELD> [ASC|DESC]] [LIMIT <n>] [OFFSET <n>]
+            [Z]<COMMAND> <FILTER-TYPE> [SUBSTRING ...]
+            WATCH:       Subscribe to changes of the list, see below.
+            FORMAT:      CSV (default), BIN or JSON, see below. Only CSV with
+                         WATCH.
+            FIELDS:      Comma separated columns to send, in that order,
+                         instead of all (not with FORMAT BIN). Case
+                         insensitive. WATCH updates are only sent if one
+                         of the columns changed.
+            WHERE:       Only hosts matching the predicates. A PREDICATE is
+                         <FIELD><OPERATOR><VALUE> without spaces, e.g.
+                         'player_count>=2'. FIELD is passworded, locked,
+                         is_ingame (VALUE 0 or 1), engineVersion (= and !=
+                         only) or rank, player_count, spec_count (=, !=, <,
+                         <=, >, >=). AND binds stronger than OR.
+            ORDER BY:    Sort the list by battleID, player_count, spec_count
+                         or rank, ascending (default) or descending.
+            LIMIT:       Send at most n hosts (not with WATCH). Without
+                         ORDER BY the list is sorted by battleID.
+            OFFSET:      Skip the first n hosts (not with WATCH).
+            Z:           Compress the list, see below. Not with WATCH.
             COMMAND:     ALL|OPEN|INGAME
             FILTER-TYPE: NONE|MOD|HOST|DESC
             SUBSTRING:   The text to look for in the column FILTER-TYPE. If
                          space[s] is encountered, each word must be in the
                          field (AND). If '|' is encountered, word[s] before
                          and after it will be searched for separately and
-                         all results will be returned (OR).
+                         all results will be returned (OR). MOD searches
+                         gameName, HOST founder, DESC whole words of the
+                         title and map (e.g. 'DESC 1v1|team ffa').
+            STATS:       Instead of hosts, reply with the metrics of the
+                         server in the Prometheus text format.
         Reply:
-            1st line: 'START <ISO 8601 timestamp, UTC>'
+            1st line: 'START <ISO 8601 timestamp, UTC>[ STALE]', STALE if the
+               list was loaded from a checkpoint at startup or the
+               connection to the lobby server was lost, until the (re-)login
+               completed.
             2nd: List of hosts as an UTF-8 encoded CSV using ; as separator and
                quoting every field. The list will be filtered if
                FILTER-TYPE != NONE.
             3rd: 'END <length of list>'
+        Z reply:
+            1st line: 'START <ISO 8601 timestamp, UTC>[ STALE]', as above.
+            2nd: '<length of payload in bytes>', followed by the payload: the
+               CSV from above, zlib compressed.
+            3rd: 'END <length of list>'
+        FORMAT BIN or JSON reply:
+            Like the Z reply (including STALE), the payload is the binary encoding described in
+            binformat.py or the JSON described in httpapi.py instead of the
+            CSV (zlib compressed if Z was given).
+        WATCH reply:
+            The same reply as above, followed by one line per changed host
+            every WATCH_INTERVAL seconds (changes are coalesced):
+              'ADD <CSV row>'     host now matches the query
+              'UPDATE <CSV row>'  host still matches, but columns changed
+              'REMOVE <battleID>' host doesn't match anymore or was closed
+            Further requests on the connection are ignored.
+
+        The connection is closed without reply if the client exceeds
+        MAX_REQUEST_RATE or doesn't read a reply within WRITE_TIMEOUT.
         """
         try:
             for line in self.rfile:
@@ -93,48 +167,26 @@ class ThreadedTCPRequestHandler(SocketServer.StreamRequestHandler, object):
                                 self.thread.name)
                     self.finish()
                     return
+                if not self.server.admit_request(self.client_address):
+                    self.finish()
+                    return
 
-                self.server.query_stats_add(line)
-                line = line.split()
-                if len(line) < 2 or (len(line) == 2 and line[1] != "NONE"):
-                    logger.error("(%s:%d) Format error: '%s'", self.client_address[0], self.client_address[1], line)
-                    continue
-                # COMMAND
-                if line[0] == "ALL":
-                    host_list = self.hosts.values()
-                elif line[0] == "OPEN":
-                    host_list = self.hosts_open.values()
-                elif line[0] == "INGAME":
-                    host_list = self.hosts_ingame.values()
-                else:
-                    logger.error("(%s:%d) Unknown COMMAND '%s'.", self.client_address[0], self.client_address[1], line[0])
+                query = self.server.parse_request(line, self.client_address)
+                if query is None:
                     continue
-                # FILTER-TYPE
-                if line[1] == "NONE":
-                    host_list_filtered = host_list
-                elif line[1] == "MOD":
-                    host_list_filtered = list()
-                    for words in " ".join(line[2:]).split("|"):
-                        host_list_filtered.extend([host for host in host_list if substr_search(words, host.gameName)])
-                elif line[1] == "HOST":
-                    host_list_filtered = list()
-                    for words in " ".join(line[2:]).split("|"):
-                        host_list_filtered.extend([host for host in host_list if substr_search(words, host.founder)])
-                else:
-                    logger.error("(%s:%d) Unknown FILTER-TYPE '%s'.", self.client_address[0], self.client_address[1],
-                                 line[0])
-                    continue
-
-                response = u"START %s\n" % datetime.datetime.utcnow().isoformat()
-                if len(host_list_filtered) > 0:
-                    csvfile = cStringIO.StringIO()
-                    csvwriter = UnicodeWriter(csvfile, quoting=csv.QUOTE_ALL)
-                    csvwriter.writerow(host_list_filtered[0].as_list_header())
-                    csvwriter.writerows([host.as_list() for host in host_list_filtered])
-                    response += csvfile.getvalue()
-                    csvfile.close()
-                response += u"END %d\n" % len(host_list_filtered)
-                self.wfile.write(response)
+                if query.watch:
+                    self.watch(query)
+                    self.finish()
+                    return
+                start = time.time()
+                response = self.server.get_response(query)
+                # a single sendall(), wfile.write() would split the response in 8 KiB chunks
+                sendall(self.request, response, WRITE_TIMEOUT)
+                self.server.request_done(query, start, len(response))
+        except socket.timeout:
+            self.server.slow_client(self.client_address)
+            self.finish()
+            return
         except socket.error, so:
             # client disconnected. that's OK, thread will terminate now
             logger.debug("(%s:%d) client disconnected after %0.1f min", self.client_address[0], self.client_address[1],
@@ -148,9 +200,302 @@ class ThreadedTCPRequestHandler(SocketServer.StreamRequestHandler, object):
             self.finish()
             raise e
 
+    def watch(self, query):
+        """
+        Send the list once, then changes to it, until disconnect.
+        """
+        subscription = self.server.subscribe(query)
+        try:
+            start = time.time()
+            response = subscription.snapshot()
+            sendall(self.request, response, WRITE_TIMEOUT)
+            self.server.request_done(query, start, len(response))
+            next_update = time.time() + WATCH_INTERVAL
+            # not select(), it fails on file descriptors >= FD_SETSIZE (1024)
+            poller = select.poll()
+            poller.register(self.request, select.POLLIN)
+            while not self.server.shutdown_now:
+                if datetime.datetime.now() - self.thread.start_time > datetime.timedelta(seconds=MAX_CONNECTION_LENGTH):
+                    logger.info("(%s:%d) Watching since %s (>%d sec), killing myself.", self.client_address[0],
+                                self.client_address[1], self.thread.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                                MAX_CONNECTION_LENGTH)
+                    return
+                # wait for the next update, but notice disconnects
+                readable = poller.poll(max(next_update - time.time(), 0) * 1000)
+                if readable and not self.request.recv(4096):
+                    return
+                if time.time() >= next_update:
+                    delta = subscription.delta()
+                    if delta:
+                        sendall(self.request, delta, WRITE_TIMEOUT)
+                        SENT_BYTES.inc(len(delta))
+                    next_update = time.time() + WATCH_INTERVAL
+        finally:
+            self.server.unsubscribe(subscription)
+
+
+class HostlistServerMixIn:
+    """
+    Query processing shared by the threaded and the event loop server.
+    """
+    lobbyclient = None  # lobbyclient.Lobbyclient, source of host lists
+    response_cache = None  # cache.ResponseCache
+    admission = None  # admission.Admission, per IP limits
+    shutdown_now = False
+    connection_count = 0
+    query_stats = None  # querystats.QueryStats
+    warm_generation = None  # snapshot generation of the last warm_cache()
+    subscriptions = ()  # watch.Subscription objects of WATCH requests
+
+    def verify_request(self, request, client_address):
+        """
+        Admit a new connection if its IP is below MAX_CONNECTIONS_PER_IP,
+        followed by self.admission.disconnect() when it is closed.
+        """
+        if self.admission.connect(client_address[0]):
+            return True
+        logger.warning("(%s:%d) Too many connections from this IP, closing.", client_address[0], client_address[1])
+        REJECTED.inc(labels=("connections",))
+        return False
+
+    def admit_request(self, client_address):
+        """
+        Returns False if the client exceeded its request rate, its connection
+        is closed then.
+        """
+        if self.admission.request(client_address[0]):
+            return True
+        logger.warning("(%s:%d) Too many requests, closing.", client_address[0], client_address[1])
+        REJECTED.inc(labels=("rate",))
+        return False
+
+    @staticmethod
+    def slow_client(client_address):
+        logger.warning("(%s:%d) Client didn't read its replies in time, closing.", client_address[0],
+                       client_address[1])
+        REJECTED.inc(labels=("slow",))
+
+    def parse_request(self, line, client_address):
+        """
+        Returns a Query object or None if the request was invalid.
+        """
+        try:
+            query = Query(line)
+        except QueryError, qe:
+            logger.error("(%s:%d) %s", client_address[0], client_address[1], qe)
+            REQUEST_ERRORS.inc()
+            return None
+        self.query_stats.add(query, line)
+        return query
+
+    @staticmethod
+    def request_done(query, start, size):
+        """
+        Record the metrics of a reply of size bytes, start is the time.time()
+        the request was read.
+        """
+        REQUEST_SECONDS.observe(time.time() - start, (query.command, query.filter_type))
+        SENT_BYTES.inc(size)
+
+    def get_response(self, query, snapshot=None):
+        """
+        Returns the complete reply to the query, from snapshot or the latest
+        published lobbyclient.Snapshot.
+        """
+        if query.stats:
+            body = REGISTRY.exposition()
+            return "START %s\n%sEND %d\n" % (datetime.datetime.utcnow().isoformat(), body, body.count("\n"))
+        if snapshot is None:
+            snapshot = self.lobbyclient.snapshot
+        return "START %s%s\n" % (datetime.datetime.utcnow().isoformat(), " STALE" if snapshot.stale else "") + \
+            self.get_response_body(query, snapshot)
+
+    def warm_cache(self):
+        """
+        Render the replies to the CACHE_WARM_QUERIES most frequent queries
+        for a new snapshot, before they are requested.
+        """
+        snapshot = self.lobbyclient.snapshot
+        if snapshot.generation == self.warm_generation:
+            return
+        self.warm_generation = snapshot.generation
+        for query in self.query_stats.hot_queries(CACHE_WARM_QUERIES, CACHE_WARM_MIN_RATE):
+            self.get_response_body(query, snapshot)
+
+    def get_response_body(self, query, snapshot):
+        """
+        Returns the UTF-8 encoded CSV and 'END' line for query. Bodies are
+        cached until the next snapshot is published.
+        """
+        body = self.response_cache.get(query.key, snapshot.generation)
+        if body is None:
+            if query.compress:
+                body = self.compress(self.get_response_body(query.uncompressed(), snapshot),
+                                     framed=query.format != "CSV")
+            elif query.format == "BIN":
+                body = self.render_bin(self.filter_hosts(query, snapshot), snapshot.generation)
+            elif query.format == "JSON":
+                body = self.render_json(self.filter_hosts(query, snapshot), snapshot.generation, query.fields)
+            else:
+                body = self.render(self.filter_hosts(query, snapshot), query.fields)
+            self.response_cache.put(query.key, snapshot.generation, body)
+        return body
+
+    @staticmethod
+    def command_hosts(command, snapshot):
+        return getattr(snapshot, COMMAND_LISTS[command])
+
+    def filter_hosts(self, query, snapshot):
+        """
+        Returns the HostRecords of snapshot matching query, in the order and
+        range requested with ORDER BY, LIMIT and OFFSET.
+        """
+        # COMMAND
+        hosts = self.command_hosts(query.command, snapshot)
+        if query.filter_type == "NONE" and not query.where:
+            if query.order_by:
+                return self.ordered_hosts(query, hosts)
+            return hosts.values()
+        # FILTER-TYPE
+        battle_ids = None
+        if query.filter_type != "NONE":
+            battle_ids = self.lobbyclient.indexes[FILTER_FIELDS[query.filter_type]].search_any(query.alternatives)
+        # WHERE
+        if query.where:
+            matches = self.lobbyclient.attribute_indexes.search(query.where)
+            battle_ids = matches if battle_ids is None else battle_ids & matches
+        host_list_filtered = list()
+        for battle_id in battle_ids:
+            host = hosts.get(battle_id)
+            # the indexes follow the lobbyclient, which may be a little ahead of the snapshot
+            if host and (not query.where or where_matches(host, query.where)):
+                host_list_filtered.append(host)
+        if query.order_by:
+            return self.sort_hosts(query, host_list_filtered)
+        return host_list_filtered
+
+    def ordered_hosts(self, query, hosts):
+        """
+        Returns the requested range of all HostRecords in hosts (a host list
+        of a snapshot), walking the sorted index of the lobbyclient instead of
+        sorting.
+        """
+        count = None if query.limit is None else query.offset + query.limit
+        index = self.lobbyclient.sorted_indexes.get(COMMAND_LISTS[query.command], query.order_by)
+        battle_ids = index.first(count, hosts.__contains__, query.descending)[query.offset:]
+        # the index follows the lobbyclient, which may be a little ahead of
+        # the snapshot: sort the few rows by their values in the snapshot
+        host_list = [hosts[battle_id] for battle_id in battle_ids]
+        host_list.sort(key=lambda host: sort_key(host, query.order_by), reverse=query.descending)
+        return host_list
+
+    @staticmethod
+    def sort_hosts(query, host_list):
+        """
+        Returns the requested range of the HostRecords in host_list.
+        """
+        def key(host):
+            return sort_key(host, query.order_by)
+        if query.limit is None:
+            host_list = sorted(host_list, key=key, reverse=query.descending)
+        elif query.descending:
+            host_list = heapq.nlargest(query.offset + query.limit, host_list, key=key)
+        else:
+            host_list = heapq.nsmallest(query.offset + query.limit, host_list, key=key)
+        return host_list[query.offset:]
+
+    def host_matches(self, query, battleID, snapshot):
+        """
+        Returns the HostRecord with battleID if it is in the result of query,
+        None otherwise.
+        """
+        host = self.command_hosts(query.command, snapshot).get(battleID)
+        if host is None or (query.where and not where_matches(host, query.where)):
+            return None
+        if query.filter_type == "NONE":
+            return host
+        index = self.lobbyclient.indexes[FILTER_FIELDS[query.filter_type]]
+        for words in query.alternatives:
+            if index.matches(host, words):
+                return host
+        return None
+
+    def subscribe(self, query):
+        subscription = Subscription(self, query)
+        # replace instead of modify, host_changed() iterates in the lobbyclient thread
+        self.subscriptions = self.subscriptions + (subscription,)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions = tuple(sub for sub in self.subscriptions if sub is not subscription)
+
+    def host_changed(self, battleID):
+        """
+        Listener for changes of hosts in the lobbyclient.
+        """
+        for subscription in self.subscriptions:
+            subscription.changed(battleID)
+
+    @staticmethod
+    def csv_row(host, fields=None):
+        """
+        Returns the CSV row of a HostRecord, only the columns in fields if
+        not None.
+        """
+        if fields is None:
+            return host.csv_row
+        return encode_csv_row([unicode(host[FIELD_INDEXES[field]]) for field in fields])
+
+    @staticmethod
+    def render(host_list, fields=None):
+        if len(host_list) > 0 and fields:
+            rows = [encode_csv_row([unicode(field) for field in fields])]
+            indexes = [FIELD_INDEXES[field] for field in fields]
+            rows.extend([encode_csv_row([unicode(host[index]) for index in indexes]) for host in host_list])
+        elif len(host_list) > 0:
+            rows = [CSV_HEADER_ROW]
+            rows.extend([host.csv_row for host in host_list])
+        else:
+            rows = list()
+        rows.append("END %d\n" % len(host_list))
+        return "".join(rows)
+
+    @staticmethod
+    def render_bin(host_list, generation):
+        payload = binformat.encode(host_list, generation)
+        return "%d\n%sEND %d\n" % (len(payload), payload, len(host_list))
 
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    @staticmethod
+    def render_json(host_list, generation, fields=None):
+        hosts = list()
+        for host in host_list:
+            host = dict(zip(CSV_HEADER, host))
+            host["passworded"] = bool(host["passworded"])
+            if fields:
+                host = dict((field, host[field]) for field in fields)
+            hosts.append(host)
+        payload = json.dumps({"generation": generation, "hosts": hosts}, separators=(",", ":"))
+        return "%d\n%sEND %d\n" % (len(payload), payload, len(host_list))
+
+    @staticmethod
+    def compress(body, framed=False):
+        """
+        Returns the body of a Z reply for the uncompressed body. framed: body
+        already has a length prefixed payload.
+        """
+        if framed:
+            length, _, rest = body.partition("\n")
+            payload, end = rest[:int(length)], rest[int(length):]
+        else:
+            end_start = body.rfind("\n", 0, -1) + 1
+            payload, end = body[:end_start], body[end_start:]
+        payload = zlib.compress(payload, COMPRESSION_LEVEL)
+        return "%d\n%s%s" % (len(payload), payload, end)
+
+
+class ThreadedTCPServer(HostlistServerMixIn, SocketServer.ThreadingMixIn, SocketServer.TCPServer):
     allow_reuse_address = True
+    request_queue_size = socket.SOMAXCONN  # default of 5 drops SYNs when many widgets connect at once
 
     def handle_error(self, request, client_address):
         logger.error("(%s) Error on connection from %s:%d, exiting!", self.thread.name, client_address[0],
@@ -158,29 +503,383 @@ class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
         request.close()
         exit(1)
 
-    def query_stats_add(self, query):
-        if len(self.query_stats) > 1000:
-                logger.warning("Probably broken client or DOS attack, not logging more than 1000 different queries.")
+    def process_request_thread(self, request, client_address):
+        CONNECTIONS.inc()
+        CONNECTIONS_ACTIVE.inc()
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            CONNECTIONS_ACTIVE.dec()
+            self.admission.disconnect(client_address[0])
+
+
+class HTTPServer(HostlistServerMixIn, SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    HTTP/JSON listener (see httpapi.py), runs next to the server of any
+    SERVER_MODE, with its own response cache.
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = socket.SOMAXCONN
+
+    def process_request_thread(self, request, client_address):
+        try:
+            SocketServer.ThreadingMixIn.process_request_thread(self, request, client_address)
+        finally:
+            self.admission.disconnect(client_address[0])
+
+
+class EventLoopConnection(object):
+    """
+    State of a client connection of the EventLoopServer.
+    """
+    def __init__(self, sock, client_address):
+        self.socket = sock
+        self.client_address = client_address
+        self.start_time = datetime.datetime.now()
+        self.inbuf = ""  # incomplete request line
+        self.outbuf = ""  # unsent part of the replies
+        self.write_deadline = None  # time.time() by which outbuf must have been sent
+        self.subscription = None  # watch.Subscription after a WATCH request
+        self.closing = False  # close once outbuf was sent, ignore further requests
+
+    def read(self):
+        """
+        Returns the complete request lines received, None on disconnect.
+        """
+        data = self.socket.recv(4096)
+        if not data:
+            return None
+        lines = (self.inbuf + data).split("\n")
+        self.inbuf = lines.pop()
+        if len(self.inbuf) > MAX_REQUEST_LENGTH:
+            logger.error("(%s:%d) Request line too long.", self.client_address[0], self.client_address[1])
+            return None
+        return lines
+
+    def queue(self, data):
+        """
+        Appends data to outbuf, returns False if it exceeds MAX_OUTPUT_BUFFER.
+        """
+        if data and not self.outbuf and WRITE_TIMEOUT is not None:
+            self.write_deadline = time.time() + WRITE_TIMEOUT
+        self.outbuf += data
+        return MAX_OUTPUT_BUFFER is None or len(self.outbuf) <= MAX_OUTPUT_BUFFER
+
+    def write(self):
+        """
+        Sends as much of outbuf as possible, returns True when all was sent.
+        """
+        try:
+            sent = self.socket.send(self.outbuf)
+        except socket.error, so:
+            if so.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return False
+            raise
+        self.outbuf = self.outbuf[sent:]
+        if self.outbuf:
+            return False
+        self.write_deadline = None
+        return True
+
+
+class EventLoopServer(HostlistServerMixIn, object):
+    """
+    Single threaded server, multiplexes all connections with epoll (poll if
+    epoll is not available).
+    """
+    reuse_port = False  # share the port with other processes
+
+    def __init__(self, server_address):
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if self.reuse_port:
+            self.socket.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+        self.socket.bind(server_address)
+        self.socket.listen(socket.SOMAXCONN)
+        self.socket.setblocking(0)
+        self.server_address = self.socket.getsockname()
+        self.connections = dict()  # fileno -> EventLoopConnection
+        if hasattr(select, "epoll"):
+            self.poller = select.epoll()
+            self.poll_timeout_unit = 1  # epoll.poll() takes seconds
         else:
+            self.poller = select.poll()
+            self.poll_timeout_unit = 1000  # poll.poll() takes milliseconds
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._is_shut_down.clear()
+        listen_fd = self.socket.fileno()
+        self.poller.register(listen_fd, select.POLLIN)
+        poll_interval = min(poll_interval, WATCH_INTERVAL)
+        next_update = time.time() + WATCH_INTERVAL
+        try:
+            while not self._shutdown_request:
+                for fd, event in self.poller.poll(poll_interval * self.poll_timeout_unit):
+                    if fd == listen_fd:
+                        self._accept()
+                        continue
+                    conn = self.connections.get(fd)
+                    if conn:
+                        self._handle_event(conn, event)
+                if time.time() >= next_update:
+                    self._periodic()
+                    next_update = time.time() + WATCH_INTERVAL
+        finally:
+            for conn in self.connections.values():
+                self._close(conn)
+            self.poller.unregister(listen_fd)
+            self.socket.close()
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+        self._is_shut_down.wait()
+
+    def _accept(self):
+        while True:
             try:
-                self.query_stats[query.strip()] += 1
-            except KeyError:
-                self.query_stats[query.strip()] = 1
-            except:
-                logger.exception("This shouldn't happen.")
+                sock, client_address = self.socket.accept()
+            except socket.error, so:
+                if so.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                logger.error("Error accepting connection: %s", so)
+                return
+            logger.debug("Connetion from %s:%d", client_address[0], client_address[1])
+            if not self.verify_request(sock, client_address):
+                sock.close()
+                continue
+            sock.setblocking(0)
+            self.connections[sock.fileno()] = EventLoopConnection(sock, client_address)
+            self.poller.register(sock.fileno(), select.POLLIN)
+            self.connection_count += 1
+            CONNECTIONS.inc()
+            CONNECTIONS_ACTIVE.inc()
+
+    def _handle_event(self, conn, event):
+        try:
+            if event & (select.POLLERR | select.POLLNVAL):
+                self._close(conn)
+                return
+            if event & (select.POLLIN | select.POLLHUP):
+                lines = conn.read()
+                if lines is None:
+                    self._close(conn)
+                    return
+                for line in lines:
+                    if conn.subscription or conn.closing:
+                        # connection is watching or over the rate limit, ignore further requests
+                        break
+                    if not self.admit_request(conn.client_address):
+                        # send the replies to the admitted requests first
+                        conn.closing = True
+                        break
+                    query = self.parse_request(line, conn.client_address)
+                    if query is None:
+                        continue
+                    start = time.time()
+                    if query.watch:
+                        conn.subscription = self.subscribe(query)
+                        response = conn.subscription.snapshot()
+                    else:
+                        response = self.get_response(query)
+                    self.request_done(query, start, len(response))
+                    if not conn.queue(response):
+                        self.slow_client(conn.client_address)
+                        self._close(conn)
+                        return
+            self._send(conn)
+        except socket.error, so:
+            if so.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            # client disconnected
+            self._close(conn)
+        except Exception, e:
+            # unexpected error, drop only this connection
+            logger.exception("(%s:%d) Unexpected error: %s", conn.client_address[0], conn.client_address[1], e)
+            self._close(conn)
+
+    def _send(self, conn):
+        if conn.outbuf:
+            if not conn.write():
+                self.poller.modify(conn.socket.fileno(),
+                                   select.POLLOUT if conn.closing else select.POLLIN | select.POLLOUT)
+                return
+            self.poller.modify(conn.socket.fileno(), select.POLLIN)
+        if conn.closing:
+            self._close(conn)
+
+    def _periodic(self):
+        """
+        Called every WATCH_INTERVAL seconds.
+        """
+        self._close_expired()
+        self._send_watch_updates()
+        if CACHE_WARM_QUERIES:
+            self.warm_cache()
+
+    def _send_watch_updates(self):
+        for conn in self.connections.values():
+            if conn.subscription:
+                delta = conn.subscription.delta()
+                SENT_BYTES.inc(len(delta))
+                if not conn.queue(delta):
+                    self.slow_client(conn.client_address)
+                    self._close(conn)
+                    continue
+                try:
+                    self._send(conn)
+                except socket.error, so:
+                    if so.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                        self._close(conn)
+
+    def _close_expired(self):
+        # remote sockets are not always closed, kill them after MAX_CONNECTION_LENGTH seconds
+        oldest = datetime.datetime.now() - datetime.timedelta(seconds=MAX_CONNECTION_LENGTH)
+        now = time.time()
+        for conn in self.connections.values():
+            if conn.write_deadline is not None and conn.write_deadline < now:
+                self.slow_client(conn.client_address)
+                self._close(conn)
+            elif conn.start_time < oldest:
+                logger.info("(%s:%d) Connected since %s (>%d sec), closing.", conn.client_address[0],
+                            conn.client_address[1], conn.start_time.strftime("%Y-%m-%d %H:%M:%S"),
+                            MAX_CONNECTION_LENGTH)
+                self._close(conn)
+
+    def _close(self, conn):
+        logger.debug("(%s:%d) client disconnected after %0.1f min", conn.client_address[0], conn.client_address[1],
+                     (datetime.datetime.now() - conn.start_time).seconds/60.0)
+        if conn.subscription:
+            self.unsubscribe(conn.subscription)
+        fd = conn.socket.fileno()
+        try:
+            self.poller.unregister(fd)
+        except (KeyError, IOError):
+            pass
+        del self.connections[fd]
+        conn.socket.close()
+        CONNECTIONS_ACTIVE.dec()
+        self.admission.disconnect(conn.client_address[0])
+
+
+class WorkerServer(EventLoopServer):
+    """
+    Event loop server in a worker process of SERVER_MODE "multiprocess". Its
+    lobbyclient is a shared.SnapshotReader.
+    """
+    reuse_port = True
+
+    def __init__(self, server_address):
+        super(WorkerServer, self).__init__(server_address)
+        self.parent_pid = os.getppid()
+
+    def get_response_body(self, query, snapshot):
+        if (query.filter_type == "NONE" and query.format == "CSV" and not query.fields and not query.where and
+                not query.order_by and not query.compress):
+            # rendered by the lobbyclient process
+            return snapshot.bodies[query.command]
+        return super(WorkerServer, self).get_response_body(query, snapshot)
+
+    def _periodic(self):
+        if os.getppid() != self.parent_pid:
+            logger.error("Lobbyclient process is gone, exiting.")
+            self._shutdown_request = True
+            return
+        # load changes for WATCH updates, even if there were no requests
+        self.lobbyclient.refresh()
+        super(WorkerServer, self)._periodic()
+
+
+class WorkerPool(object):
+    """
+    SERVER_MODE "multiprocess": this process only writes the snapshots of the
+    lobbyclient to SNAPSHOT_FILE, the clients are served by worker processes
+    (hostlistd_worker.py). Workers that exit are restarted.
+    """
+    restart_wait = 1.0  # seconds between two starts of the same worker
+
+    def __init__(self, server_address, workers):
+        self.server_address = server_address
+        self.writer = SnapshotWriter(SNAPSHOT_FILE, HostlistServerMixIn.render, SNAPSHOT_INTERVAL)
+        self.workers = [None] * workers  # subprocess.Popen objects
+        self.start_times = [0.0] * workers
+        self.restarts = 0
+        self._shutdown_request = False
+        self._is_shut_down = threading.Event()
+
+    def serve_forever(self, poll_interval=0.5):
+        self._is_shut_down.clear()
+        try:
+            while not self._shutdown_request:
+                for num, worker in enumerate(self.workers):
+                    if worker is None or worker.poll() is not None:
+                        self._start_worker(num)
+                self.writer.flush()
+                time.sleep(SNAPSHOT_INTERVAL)
+        finally:
+            for worker in self.workers:
+                if worker and worker.poll() is None:
+                    worker.terminate()
+            for worker in self.workers:
+                if worker:
+                    worker.wait()
+            self.writer.close()
+            self._is_shut_down.set()
+
+    def shutdown(self):
+        self._shutdown_request = True
+        self._is_shut_down.wait()
+
+    def _start_worker(self, num):
+        worker = self.workers[num]
+        if time.time() - self.start_times[num] < self.restart_wait:
+            return
+        if worker:
+            logger.error("Worker %d (PID %d) exited with code %d, restarting.", num, worker.pid, worker.returncode)
+            self.restarts += 1
+        self.start_times[num] = time.time()
+        self.workers[num] = subprocess.Popen([sys.executable, WORKER_SCRIPT, str(num)], close_fds=True)
+        logger.info("Started worker %d (PID %d).", num, self.workers[num].pid)
 
 
 class Hostlistd(object):
     """
-    Serves the lists of available hosts on a socket, multi-threaded.
+    Serves the lists of available hosts on a socket, either multi-threaded,
+    from a single threaded event loop or from worker processes (see
+    SERVER_MODE in settings.py).
     """
     server = None  # server object
     server_thread = None  # thread in which the servers main loop runs
+    warm_thread = None  # thread warming the response caches of threaded servers
+    http_server = None  # HTTPServer if HTTP_PORT is set
+    metrics_server = None
     ip = ""
     port = 0
 
-    def __init__(self):
-        self.server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
+    def __init__(self, mode=None):
+        """
+        mode: SERVER_MODE if None, "worker" in a worker process
+        """
+        self.mode = mode = mode or SERVER_MODE
+        self.warm_stop = threading.Event()
+        if HTTP_PORT and mode != "worker":
+            self.http_server = HTTPServer((HTTP_HOST, HTTP_PORT), HTTPRequestHandler)
+            self.http_server.query_stats = QueryStats(QUERY_STATS_SIZE, QUERY_STATS_HALF_LIFE)
+            self.http_server.response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+            self.http_server.admission = Admission(MAX_CONNECTIONS_PER_IP, MAX_REQUEST_RATE, MAX_REQUEST_BURST)
+        if mode == "multiprocess":
+            self.server = WorkerPool((HOST, PORT), WORKERS or multiprocessing.cpu_count())
+            self.ip, self.port = self.server.server_address
+            return
+        elif mode == "worker":
+            self.server = WorkerServer((HOST, PORT))
+        elif mode == "eventloop":
+            self.server = EventLoopServer((HOST, PORT))
+        else:
+            self.server = ThreadedTCPServer((HOST, PORT), ThreadedTCPRequestHandler)
         self.server.shutdown_now = False
         self.ip, self.port = self.server.server_address
         self.server.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
@@ -193,27 +892,87 @@ class Hostlistd(object):
         # closes the socket after 5 missing ACKs
         self.server.socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 5)
         self.server.connection_count = 0
-        self.server.query_stats = dict()  # query string statistics
+        self.server.query_stats = QueryStats(QUERY_STATS_SIZE, QUERY_STATS_HALF_LIFE)
+        self.server.response_cache = ResponseCache(RESPONSE_CACHE_SIZE)
+        self.server.admission = Admission(MAX_CONNECTIONS_PER_IP, MAX_REQUEST_RATE, MAX_REQUEST_BURST)
+        cache = self.server.response_cache
+        Counter("hostlistd_response_cache_hits_total", "Replies served from the response cache.",
+                func=lambda: cache.hits)
+        Counter("hostlistd_response_cache_misses_total", "Replies rendered.", func=lambda: cache.misses)
+        Gauge("hostlistd_watching_clients", "Connections subscribed with WATCH.",
+              func=lambda: len(self.server.subscriptions))
+        stats = self.server.query_stats
+        Gauge("hostlistd_top_queries", "Approximate recent requests of the most frequent queries, halved every "
+              "QUERY_STATS_HALF_LIFE seconds.", ("query",),
+              func=lambda: dict(((line,), count) for line, count, _ in stats.top(TOP_QUERIES)))
 
-    def set_host_lists(self, hosts, hosts_open, hosts_ingame):
-        self.server.hosts = hosts
-        self.server.hosts_open = hosts_open
-        self.server.hosts_ingame = hosts_ingame
+    def set_lobbyclient(self, lobbyclient):
+        if self.http_server:
+            self.http_server.lobbyclient = lobbyclient
+        if self.mode == "multiprocess":
+            lobbyclient.add_snapshot_listener(self.server.writer.publish)
+            self.server.writer.publish(lobbyclient.snapshot)
+            return
+        self.server.lobbyclient = lobbyclient
+        lobbyclient.add_host_listener(self.server.host_changed)
 
     def start(self):
         self.server_thread = threading.Thread(target=self.server.serve_forever, name="hostlistd_main")
         self.server_thread.daemon = True
         self.server_thread.start()
+        if METRICS_PORT:
+            self.metrics_server = start_http_server(METRICS_HOST, METRICS_PORT)
+        if self.http_server:
+            thread = threading.Thread(target=self.http_server.serve_forever, name="hostlistd_http")
+            thread.daemon = True
+            thread.start()
+            logger.info("HTTP/JSON listening on %s:%d", *self.http_server.server_address)
+        # the event loop servers warm their caches in their own thread
+        servers = [server for server in (self.server, self.http_server)
+                   if isinstance(server, SocketServer.ThreadingMixIn)]
+        if CACHE_WARM_QUERIES and servers:
+            self.warm_thread = threading.Thread(target=self._warm_caches, name="hostlistd_cache_warmer",
+                                                args=(servers,))
+            self.warm_thread.daemon = True
+            self.warm_thread.start()
         return self.server_thread.name
 
+    def _warm_caches(self, servers):
+        while not self.warm_stop.wait(WATCH_INTERVAL):
+            for server in servers:
+                try:
+                    server.warm_cache()
+                except Exception:
+                    logger.exception("Error warming the response cache.")
+
     def shutdown(self):
         logger.info("Shutting hostlistd server down.")
+        self.warm_stop.set()
         self.server.shutdown_now = True
         self.server.shutdown()
+        if self.metrics_server:
+            self.metrics_server.shutdown()
+        if self.http_server:
+            self.http_server.shutdown()
 
     def log_stats(self):
         now = datetime.datetime.now()
-        logger.info("Connection count: %d, Queries: %s", self.server.connection_count, self.server.query_stats)
+        if self.http_server:
+            logger.info("HTTP queries: %s, response cache: %s", self.http_server.query_stats.stats(),
+                        self.http_server.response_cache.stats())
+        if self.mode == "multiprocess":
+            logger.info("Workers: %s, restarts: %d, snapshot generation: %d",
+                        [worker.pid for worker in self.server.workers if worker], self.server.restarts,
+                        self.server.writer.generation)
+            return
+        logger.info("Connection count: %d, Queries: %s", self.server.connection_count,
+                    self.server.query_stats.stats())
+        logger.info("Response cache: %s", self.server.response_cache.stats())
+        logger.info("Rejected: %d connections (per IP limit), %d requests (rate limit), %d slow clients",
+                    REJECTED.get(("connections",)), REJECTED.get(("rate",)), REJECTED.get(("slow",)))
+        logger.info("Watching clients: %d", len(self.server.subscriptions))
+        if self.mode in ("eventloop", "worker"):
+            logger.info("Event loop connections: %d", len(self.server.connections))
         logger.info("Threads (%d): %s", len(threading.enumerate()),
                     ["%s (%0.1f min)" % (t.name, (now - t.start_time).seconds/60.0) if hasattr(t, "start_time") else
                      t.name for t in threading.enumerate()])
@@ -0,0 +1,153 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# HTTP/JSON interface to the host lists, for web frontends:
+#
+#   GET /hosts?list=<all|open|ingame>[&mod=<SUBSTRING>|&host=<SUBSTRING>|&search=<SUBSTRING>]
+#       [&fields=<FIELD>,...][&where=<PREDICATES>]
+#       [&order=<SORT-FIELD>[&desc=1]][&limit=<n>][&offset=<n>]
+#
+# The parameters work like in the line protocol ('|' for OR and spaces for
+# AND in SUBSTRING, comma separated column names in FIELD, WHERE, ORDER BY,
+# LIMIT, OFFSET).
+# The reply is {"generation": n, "hosts": [{<CSV column>: value, ...}, ...]}.
+# The ETag changes with the lobby state generation, requests with a matching
+# If-None-Match get a 304 without the list being looked at. Lists loaded from
+# a checkpoint or kept while reconnecting to the lobby server have a
+# 'Warning: 110' header until the login completed.
+# Clients over the request rate limit get a 429 (see MAX_REQUEST_RATE in
+# settings.py).
+#
+
+import BaseHTTPServer
+import logging
+import socket
+import time
+import urlparse
+
+from settings import HTTP_MAX_AGE, WRITE_TIMEOUT
+from admission import sendall
+
+logger = logging.getLogger()
+
+# distinguishes ETags of different runs, generations start at 0 again
+BOOT_ID = "%x" % int(time.time())
+
+LISTS = ("all", "open", "ingame")
+# parameter -> FILTER-TYPE
+FILTERS = {"mod": "MOD", "host": "HOST", "search": "DESC"}
+# parameter -> option of the line protocol
+OPTIONS = (("order", "ORDER BY"), ("limit", "LIMIT"), ("offset", "OFFSET"))
+
+
+class HTTPRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Handler for hostlistd.HTTPServer, keeps connections alive (HTTP/1.1).
+    """
+    protocol_version = "HTTP/1.1"
+    server_version = "hostlistd"
+    timeout = 60  # close idle keep-alive connections
+    # buffer the header lines, unbuffered each one is a packet and a 304 waits for delayed ACKs
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        self.reply(send_body=True)
+
+    def do_HEAD(self):
+        self.reply(send_body=False)
+
+    def reply(self, send_body):
+        start = time.time()
+        if not self.server.admit_request(self.client_address):
+            self.send_response(429, "Too Many Requests")
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            self.close_connection = 1
+            return
+        path, _, query_string = self.path.partition("?")
+        if path != "/hosts":
+            self.send_error(404)
+            return
+        deflate = "deflate" in self.headers.get("Accept-Encoding", "")
+        query = self.parse_query(query_string, deflate)
+        if query is None:
+            self.send_error(400, "Expected list=all|open|ingame and optionally mod=..., host=... or search=..., "
+                                 "fields=..., where=..., order=...[&desc=1], limit=..., offset=...")
+            return
+        snapshot = self.server.lobbyclient.snapshot
+        etag = '"%s-%d%s"' % (BOOT_ID, snapshot.generation, "-z" if deflate else "")
+        if etag in self.headers.get("If-None-Match", ""):
+            self.send_response(304)
+            self.send_common_headers(etag, snapshot.stale)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            self.server.request_done(query, start, 0)
+            return
+        # framed like FORMAT BIN replies: '<length>\n<payload>END n\n'
+        body = self.server.get_response_body(query, snapshot)
+        length, _, rest = body.partition("\n")
+        payload = rest[:int(length)]
+        self.send_response(200)
+        self.send_common_headers(etag, snapshot.stale)
+        self.send_header("Content-Type", "application/json; charset=utf-8")
+        if deflate:
+            # zlib format, which HTTP calls deflate
+            self.send_header("Content-Encoding", "deflate")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        if send_body:
+            self.wfile.flush()
+            try:
+                sendall(self.connection, payload, WRITE_TIMEOUT)
+            except socket.timeout:
+                self.server.slow_client(self.client_address)
+                self.close_connection = 1
+                return
+        self.server.request_done(query, start, len(payload))
+
+    def parse_query(self, query_string, deflate):
+        """
+        Returns a query.Query for the URL query string, None if it is invalid.
+        deflate: compress the reply.
+        """
+        params = urlparse.parse_qs(query_string)
+        list_name = params.get("list", ["all"])[0]
+        filters = [name for name in FILTERS if name in params]
+        known = set(FILTERS) | set(name for name, _ in OPTIONS) | set(["list", "fields", "where", "desc"])
+        if list_name not in LISTS or len(filters) > 1 or set(params) - known:
+            return None
+        words = ["FORMAT", "JSON"]
+        if "fields" in params:
+            words.extend(("FIELDS", params["fields"][0].replace(" ", "")))
+        if "where" in params:
+            words.extend(("WHERE", params["where"][0]))
+        for name, option in OPTIONS:
+            if name in params:
+                words.extend((option, params[name][0].replace(" ", "")))
+                if name == "order" and params.get("desc", ["0"])[0] != "0":
+                    words.append("DESC")
+        words.append(("Z" if deflate else "") + list_name.upper())
+        if filters:
+            words.extend((FILTERS[filters[0]], params[filters[0]][0]))
+        else:
+            words.append("NONE")
+        return self.server.parse_request(" ".join(words), self.client_address)
+
+    def send_common_headers(self, etag, stale):
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "public, max-age=%d" % HTTP_MAX_AGE)
+        self.send_header("Vary", "Accept-Encoding")
+        if stale:
+            self.send_header("Warning", '110 hostlistd "Response is Stale"')
+
+    def log_message(self, fmt, *args):
+        logger.debug("(%s:%d) " + fmt, self.client_address[0], self.client_address[1], *args)
@@ -0,0 +1,195 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import copy
+import re
+
+from lobbyclient.index import SORT_FIELDS, PREDICATE_FIELDS, flag
+from lobbyclient.models import CSV_HEADER
+
+COMMANDS = ("ALL", "OPEN", "INGAME")
+FILTER_TYPES = ("NONE", "MOD", "HOST", "DESC")
+FORMATS = ("CSV", "BIN", "JSON")
+# upper case column name -> column name
+FIELDS = dict((field.upper(), field) for field in CSV_HEADER)
+# WHERE predicate: <FIELD><OPERATOR><VALUE>, e.g. 'player_count>=2'
+PREDICATE = re.compile(r"^(\w+)(<=|>=|!=|=|<|>)(.+)$", re.UNICODE)
+FLAG_VALUES = {"0": False, "1": True, "FALSE": False, "TRUE": True}
+
+
+class QueryError(Exception):
+    pass
+
+
+class Query(object):
+    """
+    A parsed request line:
+        [WATCH] [FORMAT <FORMAT>] [FIELDS <FIELD>,...]
+        [WHERE <PREDICATE> [AND|OR <PREDICATE> ...]]
+        [ORDER BY <SORT-FIELD> [ASC|DESC]] [LIMIT <n>] [OFFSET <n>]
+        [Z]<COMMAND> <FILTER-TYPE> [SUBSTRING ...]
+    or STATS. The options before COMMAND may come in any order. LIMIT and
+    OFFSET without ORDER BY order by battleID. A PREDICATE is
+    <FIELD><OPERATOR><VALUE> without spaces, AND binds stronger than OR.
+
+    The SUBSTRING is normalized (upper case, single spaces), so that queries
+    differing only in case or whitespace share the same cache key.
+    """
+    stats = False  # STATS request: metrics instead of hosts
+    watch = False  # subscribe to changes
+    compress = False  # Z prefix: zlib compressed reply
+    format = "CSV"  # one of FORMATS
+    fields = None  # tuple of the requested columns, None: all
+    where = None  # tuple (OR) of tuples (AND) of (field, operator, value), None: no WHERE
+    order_by = None  # one of SORT_FIELDS, None: unordered
+    descending = False
+    limit = None  # maximum number of hosts, None: all
+    offset = 0  # number of hosts to skip
+    command = ""
+    filter_type = ""
+    alternatives = None  # list (OR) of lists of upper case words (AND)
+    # hashable (COMMAND, FILTER-TYPE, normalized SUBSTRING, fields, where, format, order_by, descending, limit,
+    # offset, compress)
+    key = None
+
+    def __init__(self, line):
+        words = line.decode("utf-8", "ignore").split()
+        if words == ["STATS"]:
+            self.stats = True
+            self.command = "STATS"
+            self.filter_type = "NONE"
+            return
+        while words and words[0] in ("WATCH", "FORMAT", "FIELDS", "WHERE", "ORDER", "LIMIT", "OFFSET"):
+            if words[0] == "WATCH":
+                self.watch = True
+                words = words[1:]
+            elif words[0] == "FIELDS":
+                self.fields = self.parse_fields(words[1] if len(words) > 1 else "")
+                words = words[2:]
+            elif words[0] == "WHERE":
+                self.where, words = self.parse_where(words[1:])
+            elif words[0] == "ORDER":
+                if len(words) < 3 or words[1] != "BY" or FIELDS.get(words[2].upper()) not in SORT_FIELDS:
+                    raise QueryError("Expected ORDER BY %s in '%s'." % ("|".join(SORT_FIELDS), line.strip()))
+                self.order_by = FIELDS[words[2].upper()]
+                words = words[3:]
+                if words and words[0] in ("ASC", "DESC"):
+                    self.descending = words[0] == "DESC"
+                    words = words[1:]
+            elif words[0] == "LIMIT":
+                self.limit = self.parse_count(words[:2])
+                words = words[2:]
+            elif words[0] == "OFFSET":
+                self.offset = self.parse_count(words[:2])
+                words = words[2:]
+            else:
+                if len(words) < 2 or words[1] not in FORMATS:
+                    raise QueryError("Unknown FORMAT in '%s'." % line.strip())
+                self.format = words[1]
+                words = words[2:]
+        if self.watch and self.format != "CSV":
+            raise QueryError("WATCH updates are CSV only: '%s'" % line.strip())
+        if self.fields and self.format == "BIN":
+            raise QueryError("FORMAT BIN has fixed columns: '%s'" % line.strip())
+        if self.limit is not None or self.offset:
+            if self.watch:
+                raise QueryError("WATCH can't follow a LIMIT or OFFSET: '%s'" % line.strip())
+            if self.order_by is None:
+                self.order_by = "battleID"
+        if len(words) < 2 or (len(words) == 2 and words[1] != "NONE"):
+            raise QueryError("Format error: '%s'" % line.strip())
+        self.command, self.filter_type = words[0], words[1]
+        if self.command.startswith("Z") and self.command[1:] in COMMANDS:
+            if self.watch:
+                raise QueryError("WATCH updates can't be compressed: '%s'" % line.strip())
+            self.compress = True
+            self.command = self.command[1:]
+        if self.command not in COMMANDS:
+            raise QueryError("Unknown COMMAND '%s'." % self.command)
+        if self.filter_type not in FILTER_TYPES:
+            raise QueryError("Unknown FILTER-TYPE '%s'." % self.filter_type)
+        if self.filter_type == "NONE":
+            self.alternatives = list()
+        else:
+            self.alternatives = [alt.upper().split() for alt in " ".join(words[2:]).split("|")]
+        self.key = (self.command, self.filter_type, u"|".join(u" ".join(alt) for alt in self.alternatives),
+                    self.fields, self.where, self.format, self.order_by, self.descending, self.limit, self.offset,
+                    self.compress)
+
+    @staticmethod
+    def parse_fields(text):
+        """
+        Returns the tuple of columns in the comma separated list text.
+        """
+        fields = list()
+        for name in text.split(","):
+            try:
+                field = FIELDS[name.upper()]
+            except KeyError:
+                raise QueryError("Unknown FIELD '%s'." % name)
+            if field in fields:
+                raise QueryError("FIELD '%s' requested twice." % name)
+            fields.append(field)
+        return tuple(fields)
+
+    @classmethod
+    def parse_where(cls, words):
+        """
+        Returns (where, remaining words) for the words after WHERE.
+        """
+        alternatives = [[cls.parse_predicate(words[0] if words else "")]]
+        words = words[1:]
+        while len(words) > 1 and words[0] in ("AND", "OR"):
+            if words[0] == "OR":
+                alternatives.append(list())
+            alternatives[-1].append(cls.parse_predicate(words[1]))
+            words = words[2:]
+        return tuple(tuple(predicates) for predicates in alternatives), words
+
+    @staticmethod
+    def parse_predicate(word):
+        """
+        Returns (field, operator, value) for a WHERE predicate.
+        """
+        match = PREDICATE.match(word)
+        field = FIELDS.get(match.group(1).upper()) if match else None
+        if field not in PREDICATE_FIELDS:
+            raise QueryError("Expected <%s><OPERATOR><VALUE> after WHERE, AND or OR, got '%s'." % (
+                "|".join(sorted(PREDICATE_FIELDS)), word))
+        op, text = str(match.group(2)), match.group(3)
+        if PREDICATE_FIELDS[field] is int:
+            try:
+                return field, op, int(text)
+            except ValueError:
+                raise QueryError("%s needs a number: '%s'" % (field, word))
+        if op not in ("=", "!="):
+            raise QueryError("%s can only be tested with = or !=: '%s'" % (field, word))
+        if PREDICATE_FIELDS[field] is flag:
+            try:
+                return field, op, FLAG_VALUES[text.upper()]
+            except KeyError:
+                raise QueryError("%s is 0 or 1: '%s'" % (field, word))
+        return field, op, text
+
+    @staticmethod
+    def parse_count(words):
+        """
+        Returns the number in ['LIMIT'|'OFFSET', number].
+        """
+        if len(words) < 2 or not words[1].isdigit():
+            raise QueryError("%s needs a number." % words[0])
+        return int(words[1])
+
+    def uncompressed(self):
+        """
+        Returns the same query without the Z prefix.
+        """
+        query = copy.copy(self)
+        query.compress = False
+        query.key = self.key[:-1] + (False,)
+        return query
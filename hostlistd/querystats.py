@@ -0,0 +1,179 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+import time
+
+
+class Bucket(object):
+    """
+    The entries of a QueryStats with the same count. Buckets form a list
+    ordered by count, without empty buckets.
+    """
+    __slots__ = ("count", "entries", "prev", "next")
+
+    def __init__(self, count, prev, next_):
+        self.count = count
+        self.entries = set()
+        self.prev = prev
+        self.next = next_
+
+
+class Entry(object):
+    """
+    A query counted by a QueryStats, its count is bucket.count.
+    """
+    __slots__ = ("key", "error", "query", "line", "bucket")
+
+    def __init__(self, key, error, query, line):
+        self.key = key
+        self.error = error  # count inherited from the evicted entry, the true count is at least count - error
+        self.query = query
+        self.line = line
+        self.bucket = None
+
+
+class QueryStats(object):
+    """
+    Approximate counts of the most frequent queries in fixed memory
+    (Space-Saving): at most size queries are tracked, a new one replaces
+    one with the lowest count and inherits that count as its error.
+    The entries are kept in buckets of equal count (Stream-Summary), so
+    counting and replacing take constant time. Counts are halved every
+    half_life seconds, so they follow the current traffic. The requests
+    per (COMMAND, FILTER-TYPE) are counted exactly. A size of 0 counts only
+    those.
+    """
+    def __init__(self, size, half_life):
+        self.size = size
+        self.half_life = half_life
+        self.entries = dict()  # Query.key -> Entry
+        self.lowest = None  # Bucket with the lowest count
+        self.totals = dict()  # (COMMAND, FILTER-TYPE) -> requests
+        self.next_decay = time.time() + half_life
+        self.lock = threading.Lock()
+
+    def add(self, query, line):
+        """
+        Count a request, line is the request line of query.
+        """
+        now = time.time()
+        with self.lock:
+            kind = (query.command, query.filter_type)
+            self.totals[kind] = self.totals.get(kind, 0) + 1
+            if query.stats or self.size <= 0:
+                return
+            if now >= self.next_decay:
+                self._decay(now)
+            entry = self.entries.get(query.key)
+            if entry is not None:
+                bucket = entry.bucket
+                bucket.entries.remove(entry)
+                self._put(entry, bucket, bucket.count + 1)
+                self._remove_if_empty(bucket)
+            elif len(self.entries) < self.size:
+                entry = self.entries[query.key] = Entry(query.key, 0, query, line.strip())
+                self._put(entry, None, 1)
+            else:
+                bucket = self.lowest
+                del self.entries[bucket.entries.pop().key]
+                entry = self.entries[query.key] = Entry(query.key, bucket.count, query, line.strip())
+                self._put(entry, bucket, bucket.count + 1)
+                self._remove_if_empty(bucket)
+
+    def _put(self, entry, prev, count):
+        """
+        Put entry into the bucket with count, which follows prev (or is the
+        lowest bucket if prev is None).
+        """
+        bucket = prev.next if prev else self.lowest
+        if bucket is None or bucket.count != count:
+            bucket = Bucket(count, prev, bucket)
+            if bucket.next:
+                bucket.next.prev = bucket
+            if prev:
+                prev.next = bucket
+            else:
+                self.lowest = bucket
+        bucket.entries.add(entry)
+        entry.bucket = bucket
+
+    def _remove_if_empty(self, bucket):
+        if bucket.entries:
+            return
+        if bucket.prev:
+            bucket.prev.next = bucket.next
+        else:
+            self.lowest = bucket.next
+        if bucket.next:
+            bucket.next.prev = bucket.prev
+
+    def _decay(self, now):
+        # halve the counts, merging buckets that end up with the same count and forgetting entries at 0
+        bucket = self.lowest
+        self.lowest = prev = None
+        while bucket:
+            next_ = bucket.next
+            count = bucket.count // 2
+            if count == 0:
+                for entry in bucket.entries:
+                    del self.entries[entry.key]
+            elif prev and prev.count == count:
+                for entry in bucket.entries:
+                    entry.bucket = prev
+                prev.entries |= bucket.entries
+            else:
+                bucket.count = count
+                bucket.prev = prev
+                bucket.next = None
+                if prev:
+                    prev.next = bucket
+                else:
+                    self.lowest = bucket
+                prev = bucket
+            bucket = next_
+        for entry in self.entries.itervalues():
+            entry.error //= 2
+        self.next_decay = now + self.half_life
+
+    def _ranked(self):
+        """
+        Returns the entries from the highest count down, call with the lock
+        held.
+        """
+        entries = list()
+        bucket = self.lowest
+        while bucket:
+            entries.extend(bucket.entries)
+            bucket = bucket.next
+        entries.reverse()
+        return entries
+
+    def top(self, count=None):
+        """
+        Returns [(request line, count, error), ...] of the most frequent
+        queries, the true (decayed) count is between count - error and count.
+        """
+        with self.lock:
+            return [(entry.line, entry.bucket.count, entry.error) for entry in self._ranked()[:count]]
+
+    def hot_queries(self, count, min_rate):
+        """
+        Returns the Query objects of the (at most) count most frequent
+        queries that were requested at least about min_rate times per second
+        recently.
+        """
+        min_count = min_rate * self.half_life
+        with self.lock:
+            return [entry.query for entry in self._ranked()[:count] if entry.bucket.count - entry.error >= min_count]
+
+    def stats(self):
+        totals = ", ".join("%s %s: %d" % (command, filter_type, requests)
+                           for (command, filter_type), requests in sorted(self.totals.items()))
+        top = ", ".join("'%s': %d" % (line, count) for line, count, _ in self.top(10))
+        return "%s; top: %s" % (totals, top)
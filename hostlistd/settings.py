@@ -17,3 +17,73 @@ PORT = 8222
 
 # after this many seconds a socket will be closed no matter what
 MAX_CONNECTION_LENGTH = 2 * 3600
+
+# zlib level (1-9) of replies to Z-prefixed requests, compressed once per
+# lobby state generation and query
+COMPRESSION_LEVEL = 6
+
+# number of rendered responses to keep per lobby state generation
+RESPONSE_CACHE_SIZE = 128
+
+# the QUERY_STATS_SIZE most frequent queries are counted (approximately),
+# the counts are halved every QUERY_STATS_HALF_LIFE seconds. 0 disables it
+# (and with it cache warming), only the requests per COMMAND and FILTER-TYPE
+# are counted then.
+QUERY_STATS_SIZE = 100
+QUERY_STATS_HALF_LIFE = 300
+
+# after each change of the lobby state (checked every WATCH_INTERVAL
+# seconds) the replies to the CACHE_WARM_QUERIES most frequent queries are
+# rendered in advance, if they were requested about CACHE_WARM_MIN_RATE
+# times per second or more. 0 disables cache warming.
+CACHE_WARM_QUERIES = 10
+CACHE_WARM_MIN_RATE = 0.5
+
+# how to serve clients:
+# "threaded":     one thread per connection
+# "eventloop":    all connections in a single thread (epoll), for many clients
+# "multiprocess": WORKERS processes running the event loop, sharing the port
+#                 (SO_REUSEPORT, Linux >= 3.9) and reading the host list from
+#                 SNAPSHOT_FILE, to use more than one CPU core
+SERVER_MODE = "threaded"
+
+# number of worker processes in "multiprocess" mode, 0: one per CPU core
+WORKERS = 0
+
+# "multiprocess" mode: file the host list is shared through, should be on a
+# tmpfs, and how often (in seconds) it is written at most
+SNAPSHOT_FILE = "/dev/shm/hostlistd.snapshot"
+SNAPSHOT_INTERVAL = 0.1
+
+# connections sending longer request lines are closed (eventloop mode only)
+MAX_REQUEST_LENGTH = 4096
+
+# limits per client IP, so a broken client can't slow down the others (None
+# disables a limit): connections are closed right away if the IP has
+# MAX_CONNECTIONS_PER_IP open already. Requests are rate limited with a
+# token bucket: MAX_REQUEST_RATE tokens per second, at most MAX_REQUEST_BURST
+# at once, a request without a token closes the connection (HTTP: 429). In
+# "multiprocess" mode each worker counts separately.
+MAX_CONNECTIONS_PER_IP = 20
+MAX_REQUEST_RATE = 5.0
+MAX_REQUEST_BURST = 20
+
+# slow clients: connections are closed if a reply isn't read within
+# WRITE_TIMEOUT seconds, or (eventloop and multiprocess mode) more than
+# MAX_OUTPUT_BUFFER bytes of replies and WATCH updates are waiting
+WRITE_TIMEOUT = 30
+MAX_OUTPUT_BUFFER = 4 * 1024 * 1024
+
+# WATCH requests: changes are collected and sent every this many seconds
+WATCH_INTERVAL = 1.0
+
+# serve the metrics (also available with the STATS request) in the Prometheus
+# text format on http://METRICS_HOST:METRICS_PORT/metrics, None to disable
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = None
+
+# HTTP/JSON listener for web frontends (see httpapi.py), None to disable.
+# Browsers and CDNs may cache replies for HTTP_MAX_AGE seconds.
+HTTP_HOST = "127.0.0.1"
+HTTP_PORT = None
+HTTP_MAX_AGE = 5
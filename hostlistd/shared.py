@@ -0,0 +1,195 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Host list snapshots shared between the lobbyclient process and the worker
+# processes of SERVER_MODE "multiprocess".
+#
+# Each snapshot is written to a new file, which is then renamed to
+# SNAPSHOT_FILE. A published file never changes, except for the superseded
+# flag that is set when the next file replaced it. Readers keep the old file
+# mapped until they see the flag, then map the new one.
+#
+# File layout: header, rendered bodies of ALL, OPEN and INGAME (CSV + 'END n'
+# line), marshalled list of HostRecord tuples for the other queries.
+#
+
+import logging
+import marshal
+import mmap
+import os
+import struct
+import threading
+import time
+
+from lobbyclient.index import TrigramIndex, WordIndex, SortedIndexes, AttributeIndexes
+from lobbyclient.models import HostRecord, Snapshot
+
+logger = logging.getLogger()
+
+MAGIC = "HLSNAP02"
+# magic, superseded flag, stale flag, generation, (offset, length) of ALL, OPEN, INGAME, hosts
+HEADER = struct.Struct("<8sBB6xQ8Q")
+SUPERSEDED_OFFSET = 8
+SECTIONS = ("ALL", "OPEN", "INGAME")
+
+
+class SharedSnapshot(Snapshot):
+    """
+    Snapshot read from a snapshot file, with the bodies of the unfiltered
+    replies.
+    """
+    __slots__ = ("bodies",)  # COMMAND -> CSV + 'END n' line
+
+
+class SnapshotWriter(object):
+    """
+    Writes the lobbyclient snapshots to path, at most every min_interval
+    seconds. Generations are counted here, so they keep increasing when the
+    lobbyclient is replaced.
+    """
+    def __init__(self, path, render, min_interval):
+        self.path = path
+        self.render = render  # function: list of hosts -> reply body
+        self.min_interval = min_interval
+        self.generation = 0
+        self.pending = None  # snapshot not written yet
+        self.last_write = 0.0
+        self.mm = None  # mapping of the current file, to set its superseded flag
+        self.lock = threading.Lock()
+
+    def publish(self, snapshot):
+        """
+        Snapshot listener of the lobbyclient.
+        """
+        with self.lock:
+            self.pending = snapshot
+            if time.time() - self.last_write >= self.min_interval:
+                self._write()
+
+    def flush(self):
+        """
+        Write a pending snapshot, call at least every min_interval seconds.
+        """
+        with self.lock:
+            if self.pending and time.time() - self.last_write >= self.min_interval:
+                self._write()
+
+    def _write(self):
+        snapshot, self.pending = self.pending, None
+        self.generation += 1
+        bodies = [self.render(hosts.values()) for hosts in (snapshot.hosts, snapshot.hosts_open,
+                                                             snapshot.hosts_ingame)]
+        bodies.append(marshal.dumps([tuple(host) for host in snapshot.hosts.itervalues()]))
+        sections = list()
+        offset = HEADER.size
+        for body in bodies:
+            sections.extend((offset, len(body)))
+            offset += len(body)
+        tmp_path = "%s.%d.tmp" % (self.path, os.getpid())
+        with open(tmp_path, "wb") as tmp:
+            tmp.write(HEADER.pack(MAGIC, 0, snapshot.stale, self.generation, *sections))
+            for body in bodies:
+                tmp.write(body)
+        os.rename(tmp_path, self.path)
+        if self.mm:
+            self.mm[SUPERSEDED_OFFSET] = "\1"
+            self.mm.close()
+        with open(self.path, "r+b") as new_file:
+            self.mm = mmap.mmap(new_file.fileno(), HEADER.size)
+        self.last_write = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.mm:
+                self.mm.close()
+                self.mm = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+
+class SnapshotReader(object):
+    """
+    Stands in for the lobbyclient in worker processes: provides the latest
+    snapshot, the indexes and host listeners. Not thread safe, for the
+    EventLoopServer.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.mm = None
+        self._snapshot = SharedSnapshot(0, dict(), dict(), dict())
+        self._snapshot.bodies = dict((command, "END 0\n") for command in SECTIONS)
+        self.indexes = dict((field, TrigramIndex(field)) for field in ("gameName", "founder"))
+        self.indexes["description"] = WordIndex(("title", "map"))
+        self.sorted_indexes = SortedIndexes()
+        self.attribute_indexes = AttributeIndexes()
+        self.host_listeners = ()
+
+    @property
+    def snapshot(self):
+        self.refresh()
+        return self._snapshot
+
+    def add_host_listener(self, listener):
+        self.host_listeners = self.host_listeners + (listener,)
+
+    def remove_host_listener(self, listener):
+        self.host_listeners = tuple(l for l in self.host_listeners if l != listener)
+
+    def refresh(self):
+        """
+        Map the current snapshot file, if the mapped one was superseded.
+        Returns True if a new snapshot was loaded.
+        """
+        if self.mm is not None and self.mm[SUPERSEDED_OFFSET] == "\0":
+            return False
+        try:
+            with open(self.path, "rb") as snapshot_file:
+                mm = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError):
+            # not written yet
+            return False
+        header = HEADER.unpack_from(mm)
+        if header[0] != MAGIC:
+            mm.close()
+            raise ValueError("'%s' is not a snapshot file." % self.path)
+        sections = [mm[offset:offset + length] for offset, length in zip(header[4::2], header[5::2])]
+        if self.mm is not None:
+            self.mm.close()
+        self.mm = mm
+        self._load(header[3], header[2], sections)
+        return True
+
+    def _load(self, generation, stale, sections):
+        old_hosts = self._snapshot.hosts
+        hosts = dict((record[0], HostRecord(*record)) for record in marshal.loads(sections[3]))
+        snapshot = SharedSnapshot(generation, hosts,
+                                  dict((battleID, host) for battleID, host in hosts.iteritems() if not host.is_ingame),
+                                  dict((battleID, host) for battleID, host in hosts.iteritems() if host.is_ingame),
+                                  bool(stale))
+        snapshot.bodies = dict(zip(SECTIONS, sections[:3]))
+        changed = [battleID for battleID, host in hosts.iteritems() if old_hosts.get(battleID) != host]
+        changed.extend(battleID for battleID in old_hosts if battleID not in hosts)
+        for battleID in changed:
+            host = hosts.get(battleID)
+            for index in self.indexes.values():
+                index.remove(battleID)
+                if host:
+                    index.add(host)
+        for battleID in changed:
+            self.sorted_indexes.update(battleID, (snapshot.hosts, snapshot.hosts_open, snapshot.hosts_ingame))
+            self.attribute_indexes.update(battleID, hosts)
+        self._snapshot = snapshot
+        for battleID in changed:
+            for listener in self.host_listeners:
+                try:
+                    listener(battleID)
+                except Exception:
+                    logger.exception("Exception in host listener %r", listener)
@@ -0,0 +1,66 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import threading
+
+
+class Subscription(object):
+    """
+    State of a WATCH request: the rows the client knows and the battleIDs
+    that changed since the last update was sent.
+    """
+    def __init__(self, server, query):
+        self.server = server  # HostlistServerMixIn
+        self.query = query
+        self.rows = dict()  # battleID -> CSV row last sent to the client
+        self.pending = set()  # battleIDs changed since last update
+        self.lock = threading.Lock()
+
+    def changed(self, battleID):
+        """
+        Called from the lobbyclient thread, must be cheap.
+        """
+        with self.lock:
+            self.pending.add(battleID)
+
+    def snapshot(self):
+        """
+        Returns the initial reply (same as without WATCH).
+        """
+        with self.lock:
+            self.pending.clear()
+        snapshot = self.server.lobbyclient.snapshot
+        self.rows = dict((host.battleID, self.server.csv_row(host, self.query.fields))
+                         for host in self.server.filter_hosts(self.query, snapshot))
+        return self.server.get_response(self.query, snapshot)
+
+    def delta(self):
+        """
+        Returns ADD/UPDATE/REMOVE lines for the hosts changed since the last
+        call, an empty string if nothing changed.
+        """
+        with self.lock:
+            if not self.pending:
+                return ""
+            pending, self.pending = self.pending, set()
+        snapshot = self.server.lobbyclient.snapshot
+        lines = list()
+        for battleID in pending:
+            host = self.server.host_matches(self.query, battleID, snapshot)
+            if host is None:
+                if self.rows.pop(battleID, None) is not None:
+                    lines.append("REMOVE %s\n" % battleID)
+                continue
+            row = self.server.csv_row(host, self.query.fields)
+            old_row = self.rows.get(battleID)
+            if old_row is None:
+                lines.append("ADD " + row)
+            elif old_row != row:
+                lines.append("UPDATE " + row)
+            self.rows[battleID] = row
+        return "".join(lines)
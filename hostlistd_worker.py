@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Worker process of SERVER_MODE "multiprocess" (see hostlistd/settings.py),
+# started by main.py. Serves the host list written by the lobbyclient
+# process to SNAPSHOT_FILE.
+#
+
+import logging
+import os
+from os.path import realpath, dirname
+import sys
+
+from hostlistd.hostlistd import Hostlistd
+from hostlistd.shared import SnapshotReader
+from hostlistd.settings import SNAPSHOT_FILE
+from settings import LOG_LEVEL
+
+LOG_PATH = realpath(dirname(__file__)) + '/log'
+DEBUG_FORMAT = '%(asctime)s %(levelname)-8s worker-%(num)s %(module)s.%(funcName)s:%(lineno)d  %(message)s'
+LOG_DATETIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+def main():
+    num = sys.argv[1] if len(sys.argv) > 1 else "0"
+    logging.basicConfig(level=LOG_LEVEL,
+                        format=DEBUG_FORMAT.replace("%(num)s", num),
+                        datefmt=LOG_DATETIME_FORMAT,
+                        filename=LOG_PATH + '/root_debug.log',
+                        filemode='a')
+    logger = logging.getLogger()
+
+    hl = Hostlistd(mode="worker")
+    hl.set_lobbyclient(SnapshotReader(SNAPSHOT_FILE))
+    logger.info("Worker %s (PID %d) listening on %s:%d", num, os.getpid(), hl.ip, hl.port)
+    try:
+        hl.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    logger.info("Worker %s exiting.", num)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,430 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import operator
+import re
+import threading
+
+# numeric Host attributes requests can be ordered by
+SORT_FIELDS = ("battleID", "player_count", "spec_count", "rank")
+# the host lists of Lobbyclient and Snapshot
+HOST_LISTS = ("hosts", "hosts_open", "hosts_ingame")
+# battleIDs are below this (int32 in the lobby protocol)
+BATTLE_ID_RANGE = 1 << 32
+
+
+def flag(value):
+    """
+    Returns the bool of a "0"/"1" string or a bool.
+    """
+    return bool(int(value))
+
+
+# Host attributes WHERE predicates can test -> function normalizing their values
+PREDICATE_FIELDS = {"passworded": flag, "locked": flag, "is_ingame": flag, "rank": int, "player_count": int,
+                    "spec_count": int, "engineVersion": unicode}
+# a word for WordIndex
+WORD = re.compile(r"\w+", re.UNICODE)
+# comparison operators of WHERE predicates
+OPERATORS = {"=": operator.eq, "!=": operator.ne, "<": operator.lt, "<=": operator.le, ">": operator.gt,
+             ">=": operator.ge}
+
+
+def trigrams(text):
+    return set(text[i:i + 3] for i in xrange(len(text) - 2))
+
+
+class TrigramIndex(object):
+    """
+    Case-insensitive substring index over one text field of the hosts.
+
+    Updated by the lobbyclient thread, searched by the hostlistd threads.
+    Search results are sets of battleIDs.
+    """
+    def __init__(self, field):
+        self.field = field  # name of the Host attribute
+        self.texts = dict()  # battleID -> upper cased field content
+        self.postings = dict()  # trigram -> set of battleIDs
+        self.lock = threading.Lock()
+
+    def add(self, host):
+        text = getattr(host, self.field).upper()
+        with self.lock:
+            self.texts[host.battleID] = text
+            for tri in trigrams(text):
+                try:
+                    self.postings[tri].add(host.battleID)
+                except KeyError:
+                    self.postings[tri] = set([host.battleID])
+
+    def remove(self, battleID):
+        with self.lock:
+            text = self.texts.pop(battleID, None)
+            if text is None:
+                return
+            for tri in trigrams(text):
+                posting = self.postings[tri]
+                posting.discard(battleID)
+                if not posting:
+                    del self.postings[tri]
+
+    def search(self, words):
+        """
+        Returns the battleIDs whose field contains all words (AND). Words must
+        be upper case.
+        """
+        if not words:
+            return set()
+        with self.lock:
+            postings = list()
+            for word in words:
+                for tri in trigrams(word):
+                    try:
+                        postings.append(self.postings[tri])
+                    except KeyError:
+                        return set()
+            if postings:
+                # intersect starting with the shortest posting list
+                postings.sort(key=len)
+                candidates = postings[0].intersection(*postings[1:])
+            else:
+                # only words shorter than 3 characters
+                candidates = self.texts.keys()
+            # trigrams may match in different places, verify
+            return set(battleID for battleID in candidates if all(word in self.texts[battleID] for word in words))
+
+    def search_any(self, alternatives):
+        """
+        Returns the battleIDs matching any of the alternatives (OR), each being
+        a list of words (AND).
+        """
+        result = set()
+        for words in alternatives:
+            result.update(self.search(words))
+        return result
+
+    def matches(self, host, words):
+        """
+        Returns True if the field of host contains all words (upper case).
+        """
+        text = getattr(host, self.field).upper()
+        return bool(words) and all(word in text for word in words)
+
+
+def words(text):
+    """
+    Returns the set of upper cased words in text.
+    """
+    return set(WORD.findall(text.upper()))
+
+
+class WordIndex(object):
+    """
+    Case-insensitive whole word index over text fields of the hosts.
+
+    Search only touches the posting lists of the words searched for, so it
+    doesn't get slower with more hosts. Updated by the lobbyclient thread,
+    searched by the hostlistd threads. Search results are sets of battleIDs.
+    """
+    def __init__(self, fields):
+        self.fields = fields  # names of the Host attributes
+        self.words = dict()  # battleID -> set of words of the fields
+        self.postings = dict()  # word -> set of battleIDs
+        self.lock = threading.Lock()
+
+    def host_words(self, host):
+        return words(u" ".join(getattr(host, field) for field in self.fields))
+
+    def add(self, host):
+        """
+        Add host or update its words.
+        """
+        new_words = self.host_words(host)
+        with self.lock:
+            old_words = self.words.get(host.battleID, set())
+            if new_words == old_words:
+                return
+            self._discard(host.battleID, old_words - new_words)
+            for word in new_words - old_words:
+                try:
+                    self.postings[word].add(host.battleID)
+                except KeyError:
+                    self.postings[word] = set([host.battleID])
+            self.words[host.battleID] = new_words
+
+    def remove(self, battleID):
+        with self.lock:
+            self._discard(battleID, self.words.pop(battleID, ()))
+
+    def _discard(self, battleID, old_words):
+        for word in old_words:
+            posting = self.postings[word]
+            posting.discard(battleID)
+            if not posting:
+                del self.postings[word]
+
+    def search(self, query_words):
+        """
+        Returns the battleIDs whose fields contain all words of query_words
+        (AND), e.g. [u"TEAM", u"FFA"] or [u"TEAM-FFA"].
+        """
+        wanted = set()
+        for word in query_words:
+            wanted.update(words(word))
+        if not wanted:
+            return set()
+        with self.lock:
+            try:
+                postings = sorted((self.postings[word] for word in wanted), key=len)
+            except KeyError:
+                return set()
+            return postings[0].intersection(*postings[1:])
+
+    def search_any(self, alternatives):
+        """
+        Returns the battleIDs matching any of the alternatives (OR), each being
+        a list of words (AND).
+        """
+        result = set()
+        for query_words in alternatives:
+            result.update(self.search(query_words))
+        return result
+
+    def matches(self, host, query_words):
+        """
+        Returns True if the fields of host contain all words of query_words.
+        """
+        wanted = set()
+        for word in query_words:
+            wanted.update(words(word))
+        return bool(wanted) and wanted <= self.host_words(host)
+
+
+def sort_key(host, field):
+    """
+    Returns the SortedIndex key of a Host or HostRecord: the value of field,
+    ties ordered by battleID, packed into one int (compares much faster than
+    tuples).
+    """
+    return int(getattr(host, field)) * BATTLE_ID_RANGE + int(host.battleID)
+
+
+class SortedIndex(object):
+    """
+    battleIDs of the hosts in one host list, ordered by a numeric field.
+
+    Kept sorted with bisect on every change of a host, so requests walk it
+    instead of sorting. Updated by the lobbyclient thread, read by the
+    hostlistd threads.
+    """
+    def __init__(self, field):
+        self.field = field  # name of the Host attribute
+        self.keys = dict()  # battleID -> sort key
+        self.entries = list()  # sorted keys
+        self.battle_ids = dict()  # key % BATTLE_ID_RANGE -> battleID
+        self.lock = threading.Lock()
+
+    def add(self, host):
+        """
+        Add host or move it to the position of its current value.
+        """
+        self.put(host.battleID, sort_key(host, self.field))
+
+    def put(self, battleID, key):
+        # only the updating thread writes, reading without the lock is safe
+        old_key = self.keys.get(battleID)
+        if old_key == key:
+            return
+        with self.lock:
+            if old_key is not None:
+                del self.entries[bisect.bisect_left(self.entries, old_key)]
+            self.keys[battleID] = key
+            self.battle_ids[key % BATTLE_ID_RANGE] = battleID
+            bisect.insort(self.entries, key)
+
+    def remove(self, battleID):
+        if battleID not in self.keys:
+            return
+        with self.lock:
+            key = self.keys.pop(battleID)
+            del self.battle_ids[key % BATTLE_ID_RANGE]
+            del self.entries[bisect.bisect_left(self.entries, key)]
+
+    def first(self, count, accept, descending=False):
+        """
+        Returns the battleIDs of the first count (None: all) entries for which
+        accept(battleID) is true, in ascending or descending order.
+        """
+        result = list()
+        if count == 0:
+            return result
+        with self.lock:
+            battle_ids = self.battle_ids
+            for key in (reversed(self.entries) if descending else self.entries):
+                battleID = battle_ids[key % BATTLE_ID_RANGE]
+                if accept(battleID):
+                    result.append(battleID)
+                    if len(result) == count:
+                        break
+        return result
+
+
+class SortedIndexes(object):
+    """
+    A SortedIndex per host list (HOST_LISTS) and field in SORT_FIELDS.
+    """
+    def __init__(self):
+        # list name -> SortedIndexes in the order of SORT_FIELDS
+        self.indexes = dict((list_name, [SortedIndex(field) for field in SORT_FIELDS]) for list_name in HOST_LISTS)
+
+    def get(self, list_name, field):
+        return self.indexes[list_name][SORT_FIELDS.index(field)]
+
+    def update(self, battleID, host_lists):
+        """
+        Bring the host with battleID up to date in all indexes. host_lists are
+        the current dicts (battleID -> host) of HOST_LISTS, in that order.
+        Called for every change of a host, so unchanged keys are skipped
+        without calling into the indexes.
+        """
+        keys = None
+        for list_name, hosts in zip(HOST_LISTS, host_lists):
+            host = hosts.get(battleID)
+            if host is None:
+                for index in self.indexes[list_name]:
+                    if battleID in index.keys:
+                        index.remove(battleID)
+                continue
+            if keys is None:
+                number = int(battleID)
+                keys = [int(getattr(host, field)) * BATTLE_ID_RANGE + number for field in SORT_FIELDS]
+            for index, key in zip(self.indexes[list_name], keys):
+                if index.keys.get(battleID) != key:
+                    index.put(battleID, key)
+
+
+def where_matches(host, where):
+    """
+    Returns True if the Host or HostRecord matches where: a list (OR) of
+    lists (AND) of (field, operator, value) predicates.
+    """
+    for predicates in where:
+        for field, op, value in predicates:
+            if not OPERATORS[op](PREDICATE_FIELDS[field](getattr(host, field)), value):
+                break
+        else:
+            return True
+    return False
+
+
+class AttributeIndex(object):
+    """
+    battleIDs of the hosts by the (normalized) value of one field.
+
+    A predicate is answered by merging the sets of the values it accepts,
+    so it costs the number of distinct values plus the number of matches.
+    Updated by the lobbyclient thread, searched by the hostlistd threads.
+    """
+    def __init__(self, field):
+        self.field = field  # name of the Host attribute
+        self.values = dict()  # battleID -> value
+        self.sets = dict()  # value -> set of battleIDs
+        self.lock = threading.Lock()
+
+    def put(self, battleID, value):
+        with self.lock:
+            if battleID in self.values:
+                self._discard(battleID)
+            self.values[battleID] = value
+            try:
+                self.sets[value].add(battleID)
+            except KeyError:
+                self.sets[value] = set([battleID])
+
+    def remove(self, battleID):
+        with self.lock:
+            if battleID in self.values:
+                self._discard(battleID)
+                del self.values[battleID]
+
+    def _discard(self, battleID):
+        value = self.values[battleID]
+        ids = self.sets[value]
+        ids.discard(battleID)
+        if not ids:
+            del self.sets[value]
+
+    def count(self, op, value):
+        """
+        Returns the number of battleIDs select() would return.
+        """
+        test = OPERATORS[op]
+        with self.lock:
+            return sum(len(ids) for v, ids in self.sets.iteritems() if test(v, value))
+
+    def select(self, op, value):
+        """
+        Returns the battleIDs whose value v satisfies OPERATORS[op](v, value).
+        """
+        with self.lock:
+            if op == "=":
+                return set(self.sets.get(value, ()))
+            test = OPERATORS[op]
+            result = set()
+            for v, ids in self.sets.iteritems():
+                if test(v, value):
+                    result.update(ids)
+            return result
+
+
+class AttributeIndexes(object):
+    """
+    An AttributeIndex per field in PREDICATE_FIELDS.
+    """
+    def __init__(self):
+        self.indexes = dict((field, AttributeIndex(field)) for field in PREDICATE_FIELDS)
+        # (field, normalizing function, index), iterated for every change of a host
+        self._updates = [(field, normalize, self.indexes[field]) for field, normalize in PREDICATE_FIELDS.items()]
+
+    def update(self, battleID, hosts):
+        """
+        Bring the host with battleID up to date in all indexes. hosts is the
+        current dict (battleID -> host) of all hosts.
+        """
+        host = hosts.get(battleID)
+        if host is None:
+            for _, _, index in self._updates:
+                if battleID in index.values:
+                    index.remove(battleID)
+            return
+        for field, normalize, index in self._updates:
+            value = normalize(getattr(host, field))
+            # only the updating thread writes, reading without the lock is safe
+            if index.values.get(battleID) != value:
+                index.put(battleID, value)
+
+    def search(self, where):
+        """
+        Returns the battleIDs matching where (see where_matches()). Of each
+        AND only the set of the most selective predicate is built, the other
+        predicates are tested on its battleIDs.
+        """
+        result = set()
+        for predicates in where:
+            predicates = sorted(predicates, key=lambda (field, op, value): self.indexes[field].count(op, value))
+            field, op, value = predicates[0]
+            battle_ids = self.indexes[field].select(op, value)
+            for field, op, value in predicates[1:]:
+                test = OPERATORS[op]
+                values = self.indexes[field].values
+                # values is only read, get() is atomic
+                battle_ids = [battleID for battleID in battle_ids
+                              if battleID in values and test(values.get(battleID), value)]
+            result.update(battle_ids)
+        return result
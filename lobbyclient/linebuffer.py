@@ -0,0 +1,64 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+import logging
+
+logger = logging.getLogger()
+
+
+class LineBuffer(object):
+    """
+    Splits the data read from a socket into lines (without the '\\n').
+
+    Complete lines are sliced out of each chunk, only the incomplete line at
+    its end is kept, so the buffered bytes never exceed max_line_length.
+    Longer lines are dropped.
+    """
+    def __init__(self, max_line_length):
+        self.max_line_length = max_line_length
+        self.partial = bytearray()  # start of the incomplete line
+        self.overlong = False  # skipping the rest of a line that was too long
+        self.dropped = 0  # number of lines that were too long
+
+    def feed(self, data):
+        """
+        Yields the lines completed by data.
+        """
+        start = 0
+        end = data.find("\n")
+        if end >= 0 and (self.partial or self.overlong):
+            # the line started in an earlier chunk
+            if not self.overlong:
+                if len(self.partial) + end > self.max_line_length:
+                    self._drop()
+                else:
+                    self.partial += buffer(data, 0, end)
+                    yield str(self.partial)
+            del self.partial[:]
+            self.overlong = False
+            start = end + 1
+            end = data.find("\n", start)
+        while end >= 0:
+            if end - start > self.max_line_length:
+                self._drop()
+            else:
+                yield data[start:end]
+            start = end + 1
+            end = data.find("\n", start)
+        if start < len(data) and not self.overlong:
+            if len(self.partial) + len(data) - start > self.max_line_length:
+                del self.partial[:]
+                self.overlong = True
+                self._drop()
+            else:
+                self.partial += buffer(data, start)
+
+    def _drop(self):
+        self.dropped += 1
+        logger.warning("Dropping lobby protocol line longer than %d bytes (%d dropped so far).",
+                       self.max_line_length, self.dropped)
@@ -6,15 +6,35 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import gzip
+import os
 import telnetlib
 import threading
 import logging
+import time
 
-from settings import LOBBY_SERVER_FQDN, LOBBY_SERVER_PORT, LOGIN, PING_INTERVAL
-from models import Host, User
+from settings import LOBBY_SERVER_FQDN, LOBBY_SERVER_PORT, LOGIN, PING_INTERVAL, LOBBY_RECORD_FILE, CHECKPOINT_FILE, \
+    CHECKPOINT_INTERVAL, LOBBY_READ_SIZE, LOBBY_MAX_LINE_LENGTH
+from models import Host, User, Snapshot
+from index import TrigramIndex, WordIndex, SortedIndexes, AttributeIndexes
+from linebuffer import LineBuffer
+from recorder import Recorder
+from metrics import Gauge, Histogram
 
 logger = logging.getLogger()
 
+CONSUME_SECONDS = Histogram("lobby_consume_seconds", "Time to consume a lobby protocol line.", ("command",))
+USERS = Gauge("lobby_users", "Users logged in to the lobby server.")
+HOSTS = Gauge("lobby_hosts", "Hosts (battles) by list.", ("list",))
+
+# CLIENTSTATUS status bits
+STATUS_INGAME = 1
+STATUS_AWAY = 2
+STATUS_RANK = 4 | 8 | 16
+STATUS_RANK_SHIFT = 2
+STATUS_ACCESS = 32
+STATUS_BOT = 64
+
 
 class LobbyTCPConnectException(Exception):
     pass
@@ -26,7 +46,34 @@ class Lobbyclient():
         self.hosts = dict()  # all hosts
         self.hosts_open = dict()  # hosts that are not ingame
         self.hosts_ingame = dict()  # hosts that are ingame
+        self.strings = dict()  # engine, map and game name -> [shared copy, number of hosts using it]
         self.login_info_consumed = False  # prevent error msg during initial data collection
+        self.generation = 0  # incremented on every change of users or hosts
+        # substring search indexes over host fields, and a word index over the description
+        self.indexes = dict((field, TrigramIndex(field)) for field in ("gameName", "founder"))
+        self.indexes["description"] = WordIndex(("title", "map"))
+        self.sorted_indexes = SortedIndexes()  # host lists ordered by numeric fields, for ORDER BY
+        self.attribute_indexes = AttributeIndexes()  # hosts by field value, for WHERE
+        self.host_listeners = ()  # functions called with the battleID of a changed host
+        self.snapshot_listeners = ()  # functions called with each new snapshot
+        self.snapshot = Snapshot(0, dict(), dict(), dict())  # published state, read by other threads
+        self._records = dict()  # battleID -> HostRecord of the current snapshot
+        self._dirty = set()  # battleIDs of hosts changed since the last publish()
+        # lobby command -> method consuming its arguments
+        self.handlers = {"ADDUSER": self._cmd_adduser,
+                         "BATTLECLOSED": self._cmd_battleclosed,
+                         "BATTLEOPENED": self._cmd_battleopened,
+                         "CLIENTSTATUS": self._cmd_clientstatus,
+                         "JOINEDBATTLE": self._cmd_joinedbattle,
+                         "LEFTBATTLE": self._cmd_leftbattle,
+                         "REMOVEUSER": self._cmd_removeuser,
+                         "UPDATEBATTLEINFO": self._cmd_updatebattleinfo}
+        self.recorder = None  # recorder.Recorder if LOBBY_RECORD_FILE is set
+        self.stale = False  # state loaded from a checkpoint, not from the lobby server
+        self.last_checkpoint = 0.0
+        self.partial_line = ""  # incomplete line at the end of the login_info returned by connect()
+        self.listen_thread = None  # thread running _listen(), the only one changing users and hosts
+        self.login_target = None  # Lobbyclient consuming the login dump (self or a shadow) until LOGININFOEND
 
     def connect(self):
         try:
@@ -52,7 +99,18 @@ class Lobbyclient():
             logger.info("LOGIN ACCEPTED")
 
         login_info = self.tn.read_until("LOGININFOEND\n", 2)
-        logger.info("LOGININFOEND reached")
+        if login_info.endswith("LOGININFOEND\n"):
+            logger.info("LOGININFOEND reached")
+        else:
+            logger.warning("LOGININFOEND not received within 2 seconds, the rest of the login dump follows.")
+        # after the timeout the last line can be incomplete, _listen() gets the rest
+        login_info, _, self.partial_line = login_info.rpartition("\n")
+        if LOBBY_RECORD_FILE:
+            self.recorder = Recorder(time.strftime(LOBBY_RECORD_FILE))
+            logger.info("Recording lobby traffic to '%s'.", self.recorder.filename)
+            for line in login_info.split("\n"):
+                if line:
+                    self.recorder.write(line)
         return login_info
 
     def _send_pings(self, interval, tn_socket, ev):
@@ -79,32 +137,266 @@ class Lobbyclient():
         self.ping_thread.start()
 
     def _listen(self):
-        more = ""
+        lines = LineBuffer(LOBBY_MAX_LINE_LENGTH)
+        tnsocket = self.tn.get_socket()
+        # The lobby protocol has no telnet commands, so after what telnetlib has buffered already, the socket is read
+        # directly. telnetlib reads 50 bytes at a time and looks at each byte in Python.
+        try:
+            self.tn.process_rawq()
+            some = self.partial_line + self.tn.read_very_lazy()
+        except EOFError:
+            logger.info("Connection closed by the lobby server during the login.")
+            self.tn.close()
+            self.disconnected()
+            return
         while True:
+            for txt in lines.feed(some):
+                if self.recorder:
+                    self.recorder.write(txt)
+                self._receive(txt)
+            self.publish()
+            if (CHECKPOINT_FILE and self.login_target is None and
+                    time.time() - self.last_checkpoint >= CHECKPOINT_INTERVAL):
+                self.save_checkpoint(CHECKPOINT_FILE)
             try:
-                some = self.tn.read_some()
+                some = tnsocket.recv(LOBBY_READ_SIZE)
             except Exception:
                 logger.info("Connection closed")
-                tnsocket = self.tn.get_socket()
                 self.tn.close()
                 tnsocket.close()
+                self.disconnected()
                 logger.info("Quitting '%s' thread.", self.listen_thread.name)
                 return
             if some == "":
+                logger.info("Connection closed by the lobby server.")
+                self.tn.close()
+                self.disconnected()
                 return
-            else:
-                if some.endswith("\n"):
-                    for txt in (more + some[:-1]).split("\n"):
-                        self.consume(txt)
-                    more = ""
-                else:
-                    more += some
+
+    def disconnected(self):
+        """
+        The connection to the lobby server is gone: keep serving the state,
+        but mark it as stale until the next login() brought it up to date.
+        Also writes the last checkpoint on shutdown (EXIT closes the
+        connection).
+        """
+        self.stop_recording()
+        # an incomplete login is started over after reconnecting
+        self.login_target = None
+        if CHECKPOINT_FILE and self.login_info_consumed and not self.stale:
+            self.save_checkpoint(CHECKPOINT_FILE)
+        self.stale = True
+        self.publish()
+
+    def stop_recording(self):
+        if self.recorder:
+            self.recorder.close()
+            logger.info("Recorded %d lines to '%s'.", self.recorder.lines, self.recorder.filename)
+            self.recorder = None
 
     def listen(self):
         self.listen_thread = threading.Thread(target=self._listen, name="lobbyclient_main")
         self.listen_thread.start()
         logger.info("Started lobbyclient (in '%s' thread).", self.listen_thread.name)
 
+    def add_host_listener(self, listener):
+        """
+        listener(battleID) will be called from the lobbyclient thread, whenever
+        a host was opened, closed or changed. It is called after the snapshot
+        containing the change was published.
+        """
+        # replace instead of modify, the tuple is iterated in the lobbyclient thread
+        self.host_listeners = self.host_listeners + (listener,)
+
+    def remove_host_listener(self, listener):
+        self.host_listeners = tuple(l for l in self.host_listeners if l != listener)
+
+    def add_snapshot_listener(self, listener):
+        """
+        listener(snapshot) will be called from the lobbyclient thread after
+        each publish() that replaced the snapshot.
+        """
+        self.snapshot_listeners = self.snapshot_listeners + (listener,)
+
+    def remove_snapshot_listener(self, listener):
+        self.snapshot_listeners = tuple(l for l in self.snapshot_listeners if l != listener)
+
+    def _host_changed(self, battleID):
+        self._dirty.add(battleID)
+        self.sorted_indexes.update(battleID, (self.hosts, self.hosts_open, self.hosts_ingame))
+        self.attribute_indexes.update(battleID, self.hosts)
+
+    def publish(self):
+        """
+        Replace self.snapshot, if hosts changed since the last call. Only the
+        changed hosts are copied.
+        """
+        USERS.set(len(self.users))
+        if not self._dirty and self.stale == self.snapshot.stale:
+            return
+        dirty, self._dirty = self._dirty, set()
+        records = self._records
+        for battleID in dirty:
+            host = self.hosts.get(battleID)
+            if host is None:
+                records.pop(battleID, None)
+            else:
+                records[battleID] = host.record()
+        self.snapshot = Snapshot(self.generation, dict(records),
+                                 dict((battleID, records[battleID]) for battleID in self.hosts_open
+                                      if battleID in records),
+                                 dict((battleID, records[battleID]) for battleID in self.hosts_ingame
+                                      if battleID in records),
+                                 self.stale)
+        HOSTS.set(len(self.hosts), ("all",))
+        HOSTS.set(len(self.hosts_open), ("open",))
+        HOSTS.set(len(self.hosts_ingame), ("ingame",))
+        for listener in self.snapshot_listeners:
+            try:
+                listener(self.snapshot)
+            except Exception:
+                logger.exception("Exception in snapshot listener %r", listener)
+        for battleID in dirty:
+            for listener in self.host_listeners:
+                try:
+                    listener(battleID)
+                except Exception:
+                    logger.exception("Exception in host listener %r", listener)
+
+    def login(self, login_info):
+        """
+        Consume the login dump returned by connect(). If the current state is
+        stale (loaded from a checkpoint or left over from before a reconnect),
+        the lines are consumed into a shadow Lobbyclient, which is applied
+        with reconcile() once LOGININFOEND was received. Readers keep getting
+        the old snapshot until then. If connect() timed out before
+        LOGININFOEND, _listen() consumes the rest of the dump.
+        """
+        self.login_target = Lobbyclient() if self.stale else self
+        for line in login_info.split("\n"):
+            self._receive(line)
+
+    def _receive(self, line):
+        """
+        Consume a line received from the lobby server.
+        """
+        if self.login_target is None:
+            self.consume(line)
+        elif line == "LOGININFOEND":
+            self._login_done()
+        else:
+            self.login_target.consume(line)
+
+    def _login_done(self):
+        if self.login_target is not self:
+            self.reconcile(self.login_target)
+        self.login_target = None
+        self.login_info_consumed = True
+        self.stale = False
+        self.publish()
+
+    def reconcile(self, shadow):
+        """
+        Take over the users and hosts of shadow, a Lobbyclient that consumed
+        a fresh login. Only the hosts that differ are re-indexed and published
+        as changed, so cached responses of unchanged lists stay valid and
+        WATCH clients only get the real changes.
+        """
+        old_records = dict((battleID, host.record()) for battleID, host in self.hosts.iteritems())
+        self.users = shadow.users
+        self.hosts = shadow.hosts
+        self.hosts_open = shadow.hosts_open
+        self.hosts_ingame = shadow.hosts_ingame
+        self.strings = shadow.strings
+        changed = [battleID for battleID, host in self.hosts.iteritems()
+                   if old_records.get(battleID) != host.record()]
+        changed.extend(battleID for battleID in old_records if battleID not in self.hosts)
+        for battleID in changed:
+            host = self.hosts.get(battleID)
+            for index in self.indexes.values():
+                index.remove(battleID)
+                if host:
+                    index.add(host)
+            self._host_changed(battleID)
+        self.generation += 1
+        logger.info("Reconciled %d changed hosts (of %d).", len(changed), len(self.hosts))
+
+    def checkpoint_lines(self):
+        """
+        Yields the current state as lobby protocol lines (UTF-8), consuming
+        them restores it.
+        """
+        for user in self.users.itervalues():
+            yield "ADDUSER %s %s %s %s" % (user.name, user.country, user.cpu, user.accountid)
+        for host in self.hosts.itervalues():
+            yield (u"BATTLEOPENED %s %s %s %s %s %s %s %s %s %s %s\t%s\t%s\t%s\t%s" % (
+                host.battleID, host.type, host.natType, host.founder, host.ip, host.port, host.maxPlayers,
+                host.passworded, host.rank, host.mapHash, host.engineName, host.engineVersion, host.map, host.title,
+                host.gameName)).encode("utf-8")
+            for user in host.members:
+                yield "JOINEDBATTLE %d %s" % (host.battleID, user.name)
+            yield (u"UPDATEBATTLEINFO %s %d %d %s %s" % (host.battleID, host.spec_count, host.locked, host.mapHash,
+                                                         host.map)).encode("utf-8")
+        for user in self.users.itervalues():
+            status = ((STATUS_INGAME if user.is_ingame else 0) | (STATUS_AWAY if user.is_away else 0) |
+                      (user.rank << STATUS_RANK_SHIFT) | (STATUS_ACCESS if user.is_moderator else 0) |
+                      (STATUS_BOT if user.is_bot else 0))
+            if status:
+                yield "CLIENTSTATUS %s %d" % (user.name, status)
+
+    def save_checkpoint(self, path):
+        """
+        Write the state to path, call from the lobbyclient thread.
+        """
+        start = time.time()
+        self.last_checkpoint = start
+        lines = ["# checkpoint %d" % start]
+        lines.extend(self.checkpoint_lines())
+        lines.append("")
+        tmp_path = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            # a single write, gzip is slow with many small ones
+            checkpoint = gzip.open(tmp_path, "wb", 6)
+            try:
+                checkpoint.write("\n".join(lines))
+            finally:
+                checkpoint.close()
+            os.rename(tmp_path, path)
+        except (IOError, OSError):
+            logger.exception("Cannot write checkpoint '%s'.", path)
+            return
+        logger.debug("Checkpoint of %d users and %d hosts written in %.3f s.", len(self.users), len(self.hosts),
+                     time.time() - start)
+
+    def load_checkpoint(self, path, max_age):
+        """
+        Restore the state written by save_checkpoint() and mark it as stale.
+        Checkpoints older than max_age seconds are ignored. Returns True if
+        the checkpoint was loaded.
+        """
+        if not os.path.exists(path):
+            return False
+        try:
+            checkpoint = gzip.open(path, "rb")
+            try:
+                header = checkpoint.readline().split()
+                age = time.time() - int(header[2])
+                if age > max_age:
+                    logger.info("Ignoring checkpoint '%s', it is %d s old.", path, age)
+                    return False
+                for line in checkpoint:
+                    self.consume(line.rstrip("\n"))
+            finally:
+                checkpoint.close()
+        except (IOError, OSError, IndexError, ValueError):
+            logger.exception("Cannot load checkpoint '%s'.", path)
+            return False
+        self.stale = True
+        self.publish()
+        logger.info("Loaded checkpoint '%s' (%d s old): %d users, %d hosts.", path, age, len(self.users),
+                    len(self.hosts))
+        return True
+
     def consume(self, commandstr):
         """
         Read and act upon a line of lobby protocol.
@@ -118,191 +410,207 @@ class Lobbyclient():
           LEFTBATTLE
           REMOVEUSER
           UPDATEBATTLEINFO
+
+        The line is split once into command and arguments, the command is
+        dispatched to a _cmd_<command> method through self.handlers.
+        Every successfully consumed command increments self.generation.
         """
-        if commandstr.startswith("ADDUSER"):
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#ADDUSER:server
-            # ADDUSER userName country cpu [accountID]
-            try:
-                self.users[commandstr.split()[1]] = User(*commandstr.split()[1:])
-            except ValueError:
-                logger.exception("Bad format, commandstr: '%s'", repr(commandstr))
-                return
-            except Exception:
-                logger.exception("Exception, commandstr: '%s'", repr(commandstr))
-                return
-        elif commandstr.startswith("BATTLECLOSED"):
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#BATTLECLOSED:server
-            # BATTLECLOSED battleID
-            try:
-                battleID = commandstr.split()[1]
-            except Exception:
-                logger.exception("Commandstr: '%s'", repr(commandstr))
-                return
-            # founder is founder no more
-            try:
-                self.hosts[battleID].user.host = None
-            except:
-                logger.exception("error removing host-user-founder association")
-            # remove battle from all host lists
-            for hosts in [self.hosts, self.hosts_ingame, self.hosts_open]:
-                try:
-                    del hosts[battleID]
-                except:
-                    pass
-        elif commandstr.startswith("BATTLEOPENED"):
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#BATTLEOPENED:server
-            # BATTLEOPENED battleID type natType founder ip port maxPlayers passworded rank mapHash {engineName} \
-            # {engineVersion} {map} {title} {gameName}
-            try:
-                cmd, engineVersion, _map, title, gameName = commandstr.split("\t")
-                _, battleID, _type, natType, founder, ip, port, maxPlayers, passworded, rank, mapHash, engineName = \
-                    cmd.split()
-            except ValueError:
-                logger.exception("Bad format, commandstr: '%s'", repr(commandstr))
-                return
-            except Exception:
-                logger.exception("Commandstr: '%s'", repr(commandstr))
-                return
-            loc = locals()
-            del loc["_"]
-            del loc["cmd"]
-            del loc["commandstr"]
-            del loc["self"]
-            loc["map"] = _map
-            del loc["_map"]
-            loc["type"] = _type
-            del loc["_type"]
-            for k,v in loc.items():
-                loc[k] = unicode(v, errors='ignore')
-            host = Host(loc)
-            self.hosts[battleID] = host
-            self.hosts_open[battleID] = host
-            host.user = self.users[founder]
-            host.user.host = host
-        elif commandstr.startswith("CLIENTSTATUS"):
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#CLIENTSTATUS:server
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#MYSTATUS:client
-            # CLIENTSTATUS userName status
-            # status bits: is_bot|has_access|3*rank|is_away|is_ingame
-            try:
-                _, userName, status = commandstr.split()
-            except ValueError:
-                logger.exception("Bad format, commandstr: '%s'", repr(commandstr))
-                return
-            except:
-                logger.exception("Commandstr: '%s'", repr(commandstr))
-                return
-            try:
-                user = self.users[userName]
-            except:
-                logger.exception("Exception in CLIENTSTATUS: userName '%s' in self.users?: %s, commandstr: '%s'",
-                                 userName, userName in self.users, repr(commandstr))
-                return
-            try:
-                status_bin = bin(int(status))[2:].zfill(7)
-                user.is_ingame = bool(int(status_bin[6]))
-                user.is_away = bool(int(status_bin[5]))
-                user.rank = int(status_bin[2:5], base=2)
-                user.is_moderator = bool(int(status_bin[1]))
-                user.is_bot = bool(int(status_bin[0]))
-            except:
-                logger.exception("Exception in CLIENTSTATUS: status: '%s', status_bin: '%s', commandstr: '%s'",
-                                 repr(commandstr), status, status_bin)
-                return
-            if user.host:
-                user.host.is_ingame = user.is_ingame
-                if user.is_ingame:
-                    # add host to hosts_ingame
-                    self.hosts_ingame[user.host.battleID] = user.host
-                    # remove host from hosts_open
-                    try:
-                        del self.hosts_open[user.host.battleID]
-                    except:
-                        # CLIENTSTATUS is sent twice in case of self-hosted battles
-                        pass
-                else:
-                    # add host to hosts_open
-                    self.hosts_open[user.host.battleID] = user.host
-                    # remove host from hosts_ingame
-                    try:
-                        del self.hosts_ingame[user.host.battleID]
-                    except Exception:
-                        if self.login_info_consumed:
-                            logger.exception(
-                                "Exception in CLIENTSTATUS: trying to remove host from hosts_ingame, commandstr: '%s'",
-                                repr(commandstr))
-                        else:
-                            # msg flood in in wrong order during initial setup
-                            pass
-        elif commandstr.startswith("JOINEDBATTLE"):
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#JOINEDBATTLE:server
-            # JOINEDBATTLE battleID userName [scriptPassword]
-            try:
-                _, battleID, userName = commandstr.split()
-            except ValueError:
-                logger.exception("Bad format, commandstr: '%s'", repr(commandstr))
-                return
-            self.hosts[battleID].user_list.append(self.users[userName])
-            self.hosts[battleID].set_player_count()
-        elif commandstr.startswith("LEFTBATTLE"):
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#LEFTBATTLE:server
-            # LEFTBATTLE battleID userName
-            try:
-                _, battleID, userName = commandstr.split()
-            except ValueError:
-                logger.exception("Bad format, commandstr: '%s'", repr(commandstr))
-                return
-            try:
-                self.hosts[battleID].user_list.remove(self.users[userName])
-                self.hosts[battleID].set_player_count()
-            except:
-                logger.exception("Exception in LEFTBATTLE: userName '%s' not in self.hosts[%s].user_list?", userName,
-                                 battleID)
-                return
-        elif commandstr.startswith("REMOVEUSER"):
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#REMOVEUSER:server
-            # REMOVEUSER userName
-            userName = commandstr.split()[1]
-            user = self.users[userName]
-            if user.host:
+        command, _, args = commandstr.partition(" ")
+        try:
+            handler = self.handlers[command]
+        except KeyError:
+            # ignore all other commands
+            return
+        start = time.time()
+        try:
+            handler(args)
+        except ValueError:
+            logger.exception("Bad format, commandstr: '%s'", repr(commandstr))
+            return
+        except Exception:
+            logger.exception("Exception in %s, commandstr: '%s'", command, repr(commandstr))
+            return
+        finally:
+            CONSUME_SECONDS.observe(time.time() - start, (command,))
+        self.generation += 1
+
+    def _cmd_adduser(self, args):
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#ADDUSER:server
+        # ADDUSER userName country cpu [accountID]
+        args = args.split()
+        self.users[args[0]] = User(args[0], intern(args[1]), intern(args[2]), int(args[3]) if len(args) > 3 else 0)
+
+    def _cmd_battleclosed(self, args):
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#BATTLECLOSED:server
+        # BATTLECLOSED battleID
+        battleID = int(args)
+        if battleID not in self.hosts:
+            logger.error("BATTLECLOSED for unknown battle %d.", battleID)
+        self._remove_host(battleID)
+
+    def _cmd_battleopened(self, args):
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#BATTLEOPENED:server
+        # BATTLEOPENED battleID type natType founder ip port maxPlayers passworded rank mapHash {engineName} \
+        # {engineVersion} {map} {title} {gameName}
+        args = unicode(args, "utf-8", "ignore")
+        cmd, engineVersion, _map, title, gameName = args.split("\t")
+        battleID, _type, natType, founder, ip, port, maxPlayers, passworded, rank, mapHash, engineName = cmd.split()
+        battleID = int(battleID)
+        user = self.users[founder]
+        if battleID in self.hosts:
+            logger.error("BATTLEOPENED for open battle %d, replacing it.", battleID)
+            self._remove_host(battleID)
+        # the names of engines, maps and games are shared by many hosts
+        host = Host(battleID, int(_type), int(natType), founder, ip, int(port), int(maxPlayers), int(passworded),
+                    int(rank), int(mapHash), self._share(engineName), self._share(engineVersion), self._share(_map),
+                    title, self._share(gameName))
+        host.user = user
+        self.hosts[battleID] = host
+        self.hosts_open[battleID] = host
+        host.user.host = host
+        for index in self.indexes.values():
+            index.add(host)
+        self._host_changed(battleID)
+
+    def _cmd_clientstatus(self, args):
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#CLIENTSTATUS:server
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#MYSTATUS:client
+        # CLIENTSTATUS userName status
+        # status bits: is_bot|has_access|3*rank|is_away|is_ingame
+        userName, status = args.split()
+        status = int(status)
+        user = self.users[userName]
+        user.is_ingame = bool(status & STATUS_INGAME)
+        user.is_away = bool(status & STATUS_AWAY)
+        user.rank = (status & STATUS_RANK) >> STATUS_RANK_SHIFT
+        user.is_moderator = bool(status & STATUS_ACCESS)
+        user.is_bot = bool(status & STATUS_BOT)
+        if user.host:
+            user.host.is_ingame = user.is_ingame
+            if user.is_ingame:
+                # add host to hosts_ingame
+                self.hosts_ingame[user.host.battleID] = user.host
+                # remove host from hosts_open
                 try:
-                    del self.hosts[user.host.battleID]
                     del self.hosts_open[user.host.battleID]
                 except:
+                    # CLIENTSTATUS is sent twice in case of self-hosted battles
                     pass
-            try:
-                del self.users[userName]
-            except ValueError:
-                logger.exception("Bad format, commandstr: '%s'", repr(commandstr))
-                return
-            except KeyError:
-                logger.exception("Exception in REMOVEUSER: userName '%s' not in self.users?", userName)
-                return
-        elif commandstr.startswith("UPDATEBATTLEINFO"):
-            # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#UPDATEBATTLEINFO:server
-            # UPDATEBATTLEINFO battleID spectatorCount locked mapHash {mapName}
-            try:
-                battleID, spectatorCount, locked, mapHash = commandstr.split()[1:5]
-                mapName = " ".join(commandstr.split()[5:])
-            except ValueError:
-                logger.exception("Bad format, commandstr: '%s'", repr(commandstr))
-                return
-            try:
-                host = self.hosts[battleID]
-            except KeyError:
-                logger.exception("Exception in UPDATEBATTLEINFO: battleID '%s' not in self.hosts?", battleID)
-                return
-            host.spec_count = int(spectatorCount)
-            self.hosts[battleID].set_player_count()
-            host.locked = bool(locked)
-            host.mapHash = mapHash
-            self.map = mapName
-        else:
-            # ignore all other commands
-            pass
+            else:
+                # add host to hosts_open
+                self.hosts_open[user.host.battleID] = user.host
+                # remove host from hosts_ingame
+                try:
+                    del self.hosts_ingame[user.host.battleID]
+                except KeyError:
+                    if self.login_info_consumed:
+                        logger.exception("Exception in CLIENTSTATUS: trying to remove host from hosts_ingame, "
+                                         "args: '%s'", repr(args))
+                    else:
+                        # msg flood in in wrong order during initial setup
+                        pass
+            self._host_changed(user.host.battleID)
+
+    def _cmd_joinedbattle(self, args):
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#JOINEDBATTLE:server
+        # JOINEDBATTLE battleID userName [scriptPassword]
+        battleID, userName = args.split()[:2]
+        host = self.hosts[int(battleID)]
+        user = self.users[userName]
+        if user.battle is not host:
+            # a user is in one battle at most, a missed LEFTBATTLE must not leave it in the old one
+            self._leave_battle(user)
+            user.battle = host
+            host.members.add(user)
+            host.set_player_count()
+            self._host_changed(host.battleID)
+
+    def _cmd_leftbattle(self, args):
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#LEFTBATTLE:server
+        # LEFTBATTLE battleID userName
+        battleID, userName = args.split()
+        host = self.hosts[int(battleID)]
+        user = self.users[userName]
+        if user.battle is host:
+            self._leave_battle(user)
+
+    def _cmd_removeuser(self, args):
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#REMOVEUSER:server
+        # REMOVEUSER userName
+        userName = args.strip()
+        user = self.users.pop(userName)
+        self._leave_battle(user)
+        if user.host:
+            self._remove_host(user.host.battleID)
+
+    def _leave_battle(self, user):
+        """
+        Remove user from the members of the battle it joined.
+        """
+        host, user.battle = user.battle, None
+        if host:
+            host.members.discard(user)
+            host.set_player_count()
+            self._host_changed(host.battleID)
+
+    def _remove_host(self, battleID):
+        """
+        Remove the host from all host lists and indexes, and the references
+        of its founder and members to it.
+        """
+        host = self.hosts.pop(battleID, None)
+        self.hosts_open.pop(battleID, None)
+        self.hosts_ingame.pop(battleID, None)
+        if host:
+            host.user.host = None
+            for user in host.members:
+                user.battle = None
+            for text in (host.engineName, host.engineVersion, host.map, host.gameName):
+                self._unshare(text)
+        for index in self.indexes.values():
+            index.remove(battleID)
+        self._host_changed(battleID)
+
+    def _share(self, text):
+        """
+        Returns the first equal unicode string passed that is still in use,
+        so names repeated by many hosts are stored once. Each call must be
+        followed by _unshare(text) when the host drops it.
+        """
+        entry = self.strings.get(text)
+        if entry is None:
+            entry = self.strings[text] = [text, 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _unshare(self, text):
+        entry = self.strings[text]
+        entry[1] -= 1
+        if not entry[1]:
+            del self.strings[text]
+
+    def _cmd_updatebattleinfo(self, args):
+        # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#UPDATEBATTLEINFO:server
+        # UPDATEBATTLEINFO battleID spectatorCount locked mapHash {mapName}
+        parts = args.split(" ", 4)
+        battleID, spectatorCount, locked, mapHash = parts[:4]
+        mapName = parts[4] if len(parts) > 4 else ""
+        host = self.hosts[int(battleID)]
+        host.spec_count = int(spectatorCount)
+        host.set_player_count()
+        host.locked = locked != "0"
+        host.mapHash = int(mapHash)
+        old_map, host.map = host.map, self._share(unicode(mapName, "utf-8", "ignore"))
+        self._unshare(old_map)
+        self.indexes["description"].add(host)
+        self._host_changed(host.battleID)
 
     def shutdown(self):
         logger.info("Shutting lobbyclient down.")
+        listening = self.listen_thread and self.listen_thread.isAlive()
+        if CHECKPOINT_FILE and self.login_info_consumed and not listening:
+            # otherwise the listen thread writes it in disconnected()
+            self.save_checkpoint(CHECKPOINT_FILE)
         # stop ping thread
         self.ev.set()
         self.ping_thread.join(1)
@@ -315,6 +623,9 @@ class Lobbyclient():
         logger.info("EXIT")
         try:
             self.tn.write("EXIT\n")
+            if listening:
+                # the listen thread consumes the rest until the server closes the connection
+                return
             remaining_data = self.tn.read_all()
             self.tn.close()
             logger.info("REMAINING DATA: tn.read_all():\n%s", remaining_data)
@@ -327,3 +638,7 @@ class Lobbyclient():
         logger.info("hosts:         %02d", len(self.hosts))
         logger.info("hosts_open:    %02d", len(self.hosts_open))
         logger.info("hosts_ingame:  %02d", len(self.hosts_ingame))
+        for command in sorted(self.handlers):
+            count = CONSUME_SECONDS.count((command,))
+            logger.info("%-16s %8d lines, %6.1f us/line", command, count,
+                        1e6 * CONSUME_SECONDS.sum((command,)) / count if count else 0.0)
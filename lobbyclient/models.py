@@ -5,54 +5,83 @@
 #
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
+from collections import namedtuple
+
+# Host attributes rendered by Host.as_list(), in that order
+CSV_HEADER = ["battleID", "founder", "passworded", "rank", "engineVersion", "map", "title", "gameName", "locked",
+              "spec_count", "player_count", "is_ingame"]
+CSV_FIELDS = frozenset(CSV_HEADER)
+
+# immutable copy of a Host, as published in a Snapshot
+HostRecord = namedtuple("HostRecord", CSV_HEADER + ["csv_row"])
+
+
+def encode_csv_row(row):
+    """
+    Encodes a list of unicode strings as one UTF-8 CSV line, the same as
+    csv.writer(quoting=csv.QUOTE_ALL) with the excel dialect would.
+    """
+    return '"' + '","'.join([field.encode("utf-8").replace('"', '""') for field in row]) + '"\r\n'
+
+
+CSV_HEADER_ROW = encode_csv_row([unicode(field) for field in CSV_HEADER])
 
 
 class Host(object):
     """
     An autohost or self-hosting user.
 
-    Attention: most values are stored as strings, because that's how we get it
-    from the lobby server and that's what is sent to the LUA clients.
+    Attention: text values are stored as unicode strings, because that's
+    what is sent to the LUA clients. The numbers are ints.
     """
-    battleID = 0
-    type = 0
-    natType = 0
-    founder = u""
-    ip = u""
-    port = 0
-    maxPlayers = 0
-    passworded = 0
-    rank = 0
-    mapHash = 0
-    engineName = u""
-    engineVersion = u""
-    map = u""
-    title = u""
-    gameName = u""
-    locked = False
-
-    spec_count = 0
-    user_list = None
-    player_count = 0  # len(user_list)-spec_count+1 (w/o locking, because ints are updated atomically)
-    is_ingame = False
-    user = None  # founder as reference to an User object
-
-    def __init__(self, kwargs):
-        for k, v in kwargs.items():
-            setattr(self, k, v)
-        self.user_list = list()
+    __slots__ = ("battleID", "type", "natType", "founder", "ip", "port", "maxPlayers", "passworded", "rank", "mapHash",
+                 "engineName", "engineVersion", "map", "title", "gameName", "locked", "spec_count", "members",
+                 "player_count", "is_ingame", "user", "_version", "_csv_row")
+
+    def __init__(self, battleID, _type, natType, founder, ip, port, maxPlayers, passworded, rank, mapHash, engineName,
+                 engineVersion, _map, title, gameName):
+        object.__setattr__(self, "_version", 0)  # incremented when a rendered attribute changes
+        self._csv_row = (-1, "")  # (_version, encoded CSV row)
+        self.battleID = battleID
+        self.type = _type
+        self.natType = natType
+        self.founder = founder
+        self.ip = ip
+        self.port = port
+        self.maxPlayers = maxPlayers
+        self.passworded = passworded
+        self.rank = rank
+        self.mapHash = mapHash
+        self.engineName = engineName
+        self.engineVersion = engineVersion
+        self.map = _map
+        self.title = title
+        self.gameName = gameName
+        self.locked = False
+
+        self.spec_count = 0
+        self.members = set()  # Users that joined the battle, without the founder
+        self.player_count = 0  # len(members)-spec_count+1 (w/o locking, because ints are updated atomically)
+        self.is_ingame = False
+        self.user = None  # founder as reference to an User object
+
+    def __setattr__(self, name, value):
+        if name in CSV_FIELDS and getattr(self, name, None) != value:
+            object.__setattr__(self, name, value)
+            # after setting the value, so a row rendered concurrently can't be stored as current
+            object.__setattr__(self, "_version", self._version + 1)
+        else:
+            object.__setattr__(self, name, value)
 
     def __str__(self):
-        return str(self.__dict__)
+        return str(dict((name, getattr(self, name)) for name in self.__slots__))
 
     def set_player_count(self):
         self.player_count = len(
-            self.user_list) - self.spec_count + 1  # +1 because host itself is in spec_count, but is not in user_list
+            self.members) - self.spec_count + 1  # +1 because host itself is in spec_count, but is not in members
 
     def as_list_header(self):
-        return [u"battleID", u"founder", u"passworded", u"rank",
-                u"engineVersion", u"map", u"title", u"gameName", u"locked",
-                u"spec_count", u"player_count", u"is_ingame"]
+        return [unicode(field) for field in CSV_HEADER]
 
     def as_list(self):
         return [unicode(self.battleID), self.founder,
@@ -62,24 +91,29 @@ class Host(object):
                 unicode(self.locked), unicode(self.spec_count),
                 unicode(self.player_count), unicode(self.is_ingame)]
 
+    def csv_row(self):
+        """
+        Returns as_list() as encoded CSV line, rendered only after changes.
+        """
+        version = self._version
+        cached_version, row = self._csv_row
+        if cached_version != version:
+            row = encode_csv_row(self.as_list())
+            self._csv_row = (version, row)
+        return row
+
+    def record(self):
+        return HostRecord(self.battleID, self.founder, self.passworded, self.rank, self.engineVersion, self.map,
+                          self.title, self.gameName, self.locked, self.spec_count, self.player_count,
+                          self.is_ingame, self.csv_row())
+
 
 class User(object):
     """
     A lobby account.
     """
-    name = ""
-    country = ""
-    cpu = ""
-    accountid = 0
-
-    # status bits from http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#MYSTATUS:client
-    is_ingame = False
-    is_away = False
-    rank = 0
-    is_moderator = False
-    is_bot = False
-
-    host = None  # references a Host if it's the hosts founder
+    __slots__ = ("name", "country", "cpu", "accountid", "is_ingame", "is_away", "rank", "is_moderator", "is_bot",
+                 "host", "battle")
 
     def __init__(self, name, country, cpu, accountid=0):
         self.name = name
@@ -87,5 +121,31 @@ class User(object):
         self.cpu = cpu
         self.accountid = accountid
 
+        # status bits from http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#MYSTATUS:client
+        self.is_ingame = False
+        self.is_away = False
+        self.rank = 0
+        self.is_moderator = False
+        self.is_bot = False
+
+        self.host = None  # references a Host if it's the hosts founder
+        self.battle = None  # references the Host whose battle the user joined
+
     def __str__(self):
-        return str(self.__dict__)
+        return str(dict((name, getattr(self, name)) for name in self.__slots__))
+
+
+class Snapshot(object):
+    """
+    Consistent state of all hosts, published by the lobbyclient after each
+    chunk of lobby protocol. Readers get it with a single attribute read
+    and must not modify it.
+    """
+    __slots__ = ("generation", "hosts", "hosts_open", "hosts_ingame", "stale")
+
+    def __init__(self, generation, hosts, hosts_open, hosts_ingame, stale=False):
+        self.generation = generation
+        self.hosts = hosts  # battleID -> HostRecord, all hosts
+        self.hosts_open = hosts_open  # battleID -> HostRecord, hosts that are not ingame
+        self.hosts_ingame = hosts_ingame  # battleID -> HostRecord, hosts that are ingame
+        self.stale = stale  # from a checkpoint or before a reconnect, not (yet) updated by the lobby server
@@ -0,0 +1,54 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Recordings of lobby protocol traffic, replayed by replay_server.py.
+#
+# File format: one line per protocol line, '<ms since previous line> <line>'.
+# Files ending in '.gz' are gzip compressed.
+#
+
+import gzip
+import time
+
+
+def _open(filename, mode):
+    if filename.endswith(".gz"):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+class Recorder(object):
+    """
+    Writes lobby protocol lines with timestamps to a file.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = _open(filename, "wb")
+        self.start = time.time()
+        self.last_ms = 0  # time of previous line in ms since start
+        self.lines = 0
+
+    def write(self, line):
+        now_ms = int((time.time() - self.start) * 1000)
+        self.file.write("%d %s\n" % (now_ms - self.last_ms, line))
+        self.last_ms = now_ms
+        self.lines += 1
+
+    def close(self):
+        self.file.close()
+
+
+def read_recording(filename):
+    """
+    Yields (seconds since previous line, line) from a recording.
+    """
+    with _open(filename, "rb") as recording:
+        for line in recording:
+            delay, _, line = line.rstrip("\n").partition(" ")
+            yield int(delay) / 1000.0, line
@@ -8,6 +8,7 @@
 
 import base64
 import hashlib
+import os
 
 LOBBY_SERVER_FQDN = "lobby.springrts.com"
 LOBBY_SERVER_PORT = 8200
@@ -21,6 +22,10 @@ CONNECT_DATA = {"username": "DanNew",
                 "id": "0",
                 "compat_flags": "a cl"}
 PING_INTERVAL = 30
+# bytes read from the lobby server socket at once
+LOBBY_READ_SIZE = 65536
+# longer lobby protocol lines are dropped, this also limits the buffered bytes
+LOBBY_MAX_LINE_LENGTH = 65536
 
 # http://springrts.com/dl/LobbyProtocol/ProtocolDescription.html#LOGIN:client
 # LOGIN userName password cpu localIP {lobby name and version} [userID] [{compFlags}]
@@ -28,3 +33,18 @@ PING_INTERVAL = 30
 LOGIN = "LOGIN " + CONNECT_DATA["username"] + " " + base64.b64encode(hashlib.md5(CONNECT_DATA["password"]).digest()) + \
         " " + CONNECT_DATA["cpu"] + " " + CONNECT_DATA["ip"] + " " + CONNECT_DATA["software"] + " " + \
         CONNECT_DATA["version"] + "\t" + CONNECT_DATA["id"] + "\t" + CONNECT_DATA["compat_flags"]
+
+# record all lobby traffic to this file (strftime() format, '.gz' will be
+# compressed), for replay with replay_server.py. None disables recording.
+# To run against a recording, start replay_server.py and set
+# LOBBY_SERVER_FQDN = "127.0.0.1" and LOBBY_SERVER_PORT to its port.
+LOBBY_RECORD_FILE = None
+
+# every CHECKPOINT_INTERVAL seconds the users and hosts are written to
+# CHECKPOINT_FILE (gzip compressed lobby protocol). At startup a checkpoint
+# not older than CHECKPOINT_MAX_AGE seconds is loaded and served (flagged as
+# stale) until the lobby server login completed. None disables checkpoints.
+CHECKPOINT_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "log",
+                               "lobby_checkpoint.gz")
+CHECKPOINT_INTERVAL = 60
+CHECKPOINT_MAX_AGE = 3600
@@ -15,7 +15,9 @@ import threading
 from time import sleep
 
 from lobbyclient.lobbyclient import Lobbyclient
+from lobbyclient.settings import CHECKPOINT_FILE, CHECKPOINT_MAX_AGE
 from hostlistd.hostlistd import Hostlistd
+from metrics import Counter
 from settings import LOG_LEVEL, LOG_INTERVAL, LOBBY_CONNECT_TRIES, LOBBY_CONNECT_RETRY_WAIT
 
 LOG_PATH = realpath(dirname(__file__)) + '/log'
@@ -36,6 +38,8 @@ ev = threading.Event()  # signaling object
 stats_thread = None  # statistics thread
 watchdog_thread = None  # lobbyclient watchdog thread
 
+LOBBY_RECONNECTS = Counter("lobby_reconnects_total", "Reconnections to the lobby server after a disconnect.")
+
 
 def log_stats(interval, ev):
     global hl, lc
@@ -65,7 +69,9 @@ def _lobbyclient_watchdog():
         return
     lc.shutdown()
     hl.log_stats()
-    logger.info("Creating new Lobbyclient object and threads.")
+    LOBBY_RECONNECTS.inc()
+    # the same Lobbyclient reconnects, hostlistd keeps serving its (stale) state until the login is applied
+    logger.info("Reconnecting Lobbyclient, starting new threads.")
     launch_lobbyclient()
     logger.info("Creating new lobbyclient_watchdog thread.")
     launch_lobbyclient_watchdog()
@@ -88,7 +94,8 @@ def launch_lobbyclient():
     while retries < LOBBY_CONNECT_TRIES:
         try:
             logger.info("Connecting to lobby server...")
-            lc = Lobbyclient()
+            if lc is None:
+                lc = Lobbyclient()
             login_info = lc.connect()
             logger.info("... connected.")
             break
@@ -105,9 +112,7 @@ def launch_lobbyclient():
 
     lc.ping()
     try:
-        for li in login_info.split("\n"):
-            lc.consume(li)
-        lc.login_info_consumed = True
+        lc.login(login_info)
         logger.info("login_info consumed")
         lc.log_stats()
         if len(lc.users) == 0:
@@ -122,6 +127,14 @@ def launch_lobbyclient():
         logger.exception("Exception:")
 
 
+def load_checkpoint():
+    global lc
+
+    lc = Lobbyclient()
+    if CHECKPOINT_FILE:
+        lc.load_checkpoint(CHECKPOINT_FILE, CHECKPOINT_MAX_AGE)
+
+
 def launch_hostlistd():
     global hl, lc
 
@@ -129,9 +142,10 @@ def launch_hostlistd():
         hl = Hostlistd()
     except Exception, e:
         logger.exception("Cannot create Hostlistd server: %s", e)
-        lc.shutdown()
+        if lc.login_info_consumed:
+            lc.shutdown()
         exit(1)
-    hl.set_host_lists(lc.hosts, lc.hosts_open, lc.hosts_ingame)
+    hl.set_lobbyclient(lc)
     hl.start()
     logger.info("hostlistd listening on %s:%d", hl.ip, hl.port)
 
@@ -143,9 +157,15 @@ def launch_log_stats():
     stats_thread.start()
 
 
-launch_lobbyclient()
+load_checkpoint()
+if lc.stale:
+    # serve the checkpoint while logging in to the lobby server
+    launch_hostlistd()
+    launch_lobbyclient()
+else:
+    launch_lobbyclient()
+    launch_hostlistd()
 launch_lobbyclient_watchdog()
-launch_hostlistd()
 launch_log_stats()
 
 hl.log_stats()
@@ -161,7 +181,8 @@ logger.info("Shutting down")
 ev.set()
 
 lc.shutdown()
-lc.listen_thread.join(2)
+# the listen thread writes the last checkpoint when EXIT closes the connection
+lc.listen_thread.join(10)
 if lc.listen_thread.isAlive():
     logger.error("ERROR: lc.listen_thread is still alive")
 else:
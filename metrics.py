@@ -0,0 +1,198 @@
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Counters, gauges and fixed-bucket histograms shared by hostlistd and
+# lobbyclient, exposed in the Prometheus text format by the STATS request
+# and optionally by a small HTTP server.
+#
+
+import bisect
+import threading
+import BaseHTTPServer
+import logging
+
+logger = logging.getLogger()
+
+# latency buckets in seconds
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _format_labels(labelnames, labelvalues, extra=""):
+    pairs = ['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+             for name, value in zip(labelnames, labelvalues)]
+    if extra:
+        pairs.append(extra)
+    return "{%s}" % ",".join(pairs) if pairs else ""
+
+
+class Metric(object):
+    """
+    Base class: a named metric with optional labels. Values are stored per
+    tuple of label values. If func is given, it is called at exposition time
+    instead, to get the value of state kept elsewhere (with labelnames: a
+    dict of label values tuple -> value).
+    """
+    type = ""
+
+    def __init__(self, name, help_text, labelnames=(), registry=None, func=None):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.values = dict()  # tuple of label values -> value
+        self.lock = threading.Lock()
+        self.func = func
+        if not self.labelnames:
+            self.values[()] = self.zero()
+        (registry or REGISTRY).register(self)
+
+    def zero(self):
+        return 0
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+    def samples(self):
+        """
+        Yields (suffix, labels string, value) for the exposition.
+        """
+        if self.func:
+            try:
+                if self.labelnames:
+                    for labels, value in sorted(self.func().items()):
+                        yield "", _format_labels(self.labelnames, labels), value
+                else:
+                    yield "", "", self.func()
+            except Exception:
+                logger.exception("Error reading metric %s", self.name)
+            return
+        for labels, value in sorted(self.values.items()):
+            yield "", _format_labels(self.labelnames, labels), value
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def set(self, value, labels=()):
+        self.values[labels] = value
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, amount=1, labels=()):
+        self.inc(-amount, labels)
+
+
+class Histogram(Metric):
+    """
+    Fixed bucket histogram. Per label tuple a list of the bucket counts
+    (the last one for values above all buckets) plus the sum is stored.
+    """
+    type = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), registry=None, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        super(Histogram, self).__init__(name, help_text, labelnames, registry)
+
+    def zero(self):
+        return [0] * (len(self.buckets) + 1) + [0.0]
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            try:
+                counts = self.values[labels]
+            except KeyError:
+                counts = self.values[labels] = self.zero()
+            counts[index] += 1
+            counts[-1] += value
+
+    def count(self, labels=()):
+        counts = self.values.get(labels)
+        return sum(counts[:-1]) if counts else 0
+
+    def sum(self, labels=()):
+        counts = self.values.get(labels)
+        return counts[-1] if counts else 0.0
+
+    def samples(self):
+        for labels, counts in sorted(self.values.items()):
+            counts = list(counts)  # observe() may run concurrently
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                yield "_bucket", _format_labels(self.labelnames, labels, 'le="%s"' % (
+                    "+Inf" if bound == float("inf") else repr(bound))), cumulative
+            yield "_sum", _format_labels(self.labelnames, labels), counts[-1]
+            yield "_count", _format_labels(self.labelnames, labels), cumulative
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = list()
+        self.lock = threading.Lock()
+
+    def register(self, metric):
+        """
+        Add metric, replacing a metric of the same name.
+        """
+        with self.lock:
+            self.metrics = [m for m in self.metrics if m.name != metric.name] + [metric]
+
+    def exposition(self):
+        """
+        Returns all metrics in the Prometheus text format.
+        """
+        lines = list()
+        for metric in self.metrics:
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, metric.type))
+            for suffix, labels, value in metric.samples():
+                lines.append("%s%s%s %s" % (metric.name, suffix, labels, repr(float(value))
+                                            if isinstance(value, float) else value))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+class MetricsHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != "/metrics":
+            self.send_error(404)
+            return
+        body = REGISTRY.exposition()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, fmt, *args):
+        logger.debug("metrics http: " + fmt, *args)
+
+
+def start_http_server(host, port):
+    """
+    Serve GET /metrics in a daemon thread.
+    """
+    server = BaseHTTPServer.HTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name="metrics_http")
+    thread.daemon = True
+    thread.start()
+    logger.info("Metrics on http://%s:%d/metrics", host, port)
+    return server
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+
+# This file is part of the "springrts-hostlist" program. It is published
+# under the GPLv3.
+#
+# Copyright (C) 2014 Daniel Troeder (daniel #at# admin-box #dot# com)
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+#
+# Local stand-in for the TASServer lobby server: replays a recording made
+# with LOBBY_RECORD_FILE (see lobbyclient/settings.py) to each client that
+# logs in.
+#
+# Replay at 10x speed:
+# $ ./replay_server.py --speed 10 log/lobby-20141020-120000.rec.gz
+#
+# Then set LOBBY_SERVER_FQDN = "127.0.0.1" and LOBBY_SERVER_PORT = 8200 in
+# lobbyclient/settings.py and start main.py.
+#
+
+import argparse
+import socket
+import threading
+import time
+
+from lobbyclient.recorder import read_recording
+
+# TASSERVER protocolVersion springVersion udpPort serverMode
+GREETING = "TASServer 0.36 98.0 8201 0\n"
+
+
+def read_lines(recording):
+    """
+    Returns the login dump (up to and including LOGININFOEND) and the
+    following list of (delay, line).
+    """
+    login, live = list(), list()
+    for delay, line in read_recording(recording):
+        if live or (login and login[-1] == "LOGININFOEND"):
+            live.append((delay, line))
+        else:
+            login.append(line)
+    if "LOGININFOEND" not in login:
+        login.append("LOGININFOEND")
+    return login, live
+
+
+class ReplayConnection(threading.Thread):
+    def __init__(self, sock, address, login, live, speed):
+        super(ReplayConnection, self).__init__(name="replay-%s:%d" % address)
+        self.daemon = True
+        self.socket = sock
+        self.address = address
+        self.login = login
+        self.live = live
+        self.speed = speed  # 0: as fast as possible
+        self.logged_in = threading.Event()
+        self.closed = threading.Event()
+        self.lock = threading.Lock()  # for socket.sendall()
+
+    def send(self, data):
+        with self.lock:
+            self.socket.sendall(data)
+
+    def run(self):
+        reader = threading.Thread(target=self.read_client, name=self.name + "-reader")
+        reader.daemon = True
+        reader.start()
+        try:
+            self.send(GREETING)
+            self.logged_in.wait()
+            if self.closed.is_set():
+                return
+            self.send("\n".join(self.login) + "\n")
+            print "(%s:%d) logged in, sent %d login lines" % (self.address[0], self.address[1], len(self.login))
+            self.replay()
+        except socket.error, so:
+            print "(%s:%d) %s" % (self.address[0], self.address[1], so)
+        finally:
+            self.closed.wait()
+            self.socket.close()
+
+    def replay(self):
+        start = time.time()
+        due = 0.0  # seconds since start at which the next line is due
+        batch = list()
+        for delay, line in self.live:
+            if self.closed.is_set():
+                return
+            if self.speed:
+                due += delay / self.speed
+                wait = due - (time.time() - start)
+                if wait > 0:
+                    # send everything that is due before sleeping
+                    if batch:
+                        self.send("".join(batch))
+                        batch = list()
+                    time.sleep(wait)
+            batch.append(line + "\n")
+            if len(batch) >= 1000:
+                self.send("".join(batch))
+                batch = list()
+        if batch:
+            self.send("".join(batch))
+        elapsed = time.time() - start
+        print "(%s:%d) replayed %d lines in %0.1f sec (%d lines/sec)" % (
+            self.address[0], self.address[1], len(self.live), elapsed, len(self.live) / elapsed if elapsed else 0)
+
+    def read_client(self):
+        try:
+            for line in self.socket.makefile():
+                if line.startswith("LOGIN "):
+                    self.send("ACCEPTED %s\n" % line.split()[1])
+                    self.logged_in.set()
+                elif line.startswith("PING"):
+                    self.send("PONG\n")
+                elif line.startswith("EXIT"):
+                    break
+        except socket.error:
+            pass
+        self.closed.set()
+        self.logged_in.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay a lobby recording as a local TASServer.")
+    parser.add_argument("recording", help="file written by the lobbyclient with LOBBY_RECORD_FILE set")
+    parser.add_argument("--host", default="127.0.0.1", help="interface to bind to (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=8200, help="port to bind to (default: %(default)s)")
+    parser.add_argument("--speed", type=float, default=1.0,
+                        help="replay speed factor, 0 for as fast as possible (default: %(default)s)")
+    args = parser.parse_args()
+
+    login, live = read_lines(args.recording)
+    print "Loaded %d login lines and %d lines of live traffic (%0.1f sec)." % (
+        len(login), len(live), sum(delay for delay, _ in live))
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((args.host, args.port))
+    server.listen(5)
+    print "Listening on %s:%d, speed: %s" % (args.host, args.port, args.speed or "max")
+    try:
+        while True:
+            sock, address = server.accept()
+            ReplayConnection(sock, address, login, live, args.speed).start()
+    except KeyboardInterrupt:
+        pass
+    server.close()
+
+
+if __name__ == "__main__":
+    main()